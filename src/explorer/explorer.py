@@ -2,10 +2,10 @@
 
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout, RequestError
-from tensorflow.keras import models
 from flask import Flask, abort, jsonify, render_template, request
 
-from parsing.message_segmenter import predict_raw_text, load_fasttext_model, reformat_raw_text_recursive
+from parsing.message_segmenter import predict_raw_text, load_fasttext_model, reformat_raw_text_recursive, \
+    MessageSegmenter
 from util import util
 
 
@@ -15,7 +15,7 @@ app.config.from_object('conf.local_settings')
 
 es = Elasticsearch(app.config.get('ES_SEED_HOSTS'), **app.config.get('ES_CONNECTION_PROPERTIES'), timeout=140)
 load_fasttext_model(app.config.get('FASTTEXT_MODEL'))
-line_model = models.load_model(app.config.get('SEGMENTER_MODEL'))
+line_model = MessageSegmenter(app.config.get('SEGMENTER_MODEL'))
 
 
 @app.route('/')
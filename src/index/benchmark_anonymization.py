@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+from base64 import b64encode
+import copy
+from hashlib import sha256
+import json
+import logging
+import random
+import sys
+from time import perf_counter
+
+import click
+
+from util.anonymization import EmailAnonymizer
+
+
+def _reference_anonymize(text, headers):
+    """
+    Original (unmemoized) message anonymization of the message index annotator,
+    which :class:`util.anonymization.EmailAnonymizer` has to reproduce exactly.
+
+    :param text: message text
+    :param headers: dict of message headers
+    :return: anonymized text and headers
+    """
+    email_regex = EmailAnonymizer.EMAIL_REGEX
+
+    def email_replacement(e):
+        return b64encode(sha256(e.group().encode()).digest())[:16].decode() + '@example.com'
+
+    def extract_email_addr(s):
+        try:
+            return email_regex.search(s).group()
+        except (TypeError, AttributeError):
+            return s
+
+    text = email_regex.sub(email_replacement, text)
+    headers = {k: headers[k] for k in headers if headers[k] and k in EmailAnonymizer.KEPT_HEADERS}
+    for h in headers:
+        if h in {'cc', 'to'}:
+            if type(headers[h]) is not list:
+                headers[h] = [headers[h]]
+            headers[h] = [extract_email_addr(x) for x in headers[h]]
+        elif h in {'from', 'from_email', 'in_reply_to'}:
+            headers[h] = extract_email_addr(headers[h])
+
+        if type(headers[h]) is list:
+            headers[h] = [email_regex.sub(email_replacement, x) for x in headers[h]]
+        elif h != 'list_id':
+            headers[h] = email_regex.sub(email_replacement, headers[h])
+
+    return text, headers
+
+
+def _generate_messages(texts, num_messages, num_addresses, seed=0):
+    """
+    Generate synthetic messages with headers from a list of message texts.
+
+    :param texts: message texts
+    :param num_messages: number of messages to generate
+    :param num_addresses: number of distinct email addresses
+    :param seed: random seed
+    :return: list of (message text, headers)
+    """
+    rand = random.Random(seed)
+    addresses = ['user{}@list{}.example.org'.format(i, i % 50) for i in range(num_addresses)]
+
+    messages = []
+    for i in range(num_messages):
+        text = '\n'.join('On Monday, {} wrote:'.format(rand.choice(addresses)) if rand.random() < 0.05 else l
+                         for l in rand.choice(texts).split('\n'))
+        headers = {
+            'message_id': '<{}@host.example.com>'.format(i),
+            'subject': 'Re: question' if i % 7 else 'Re: mail from {}'.format(rand.choice(addresses)),
+            'from': 'Jane Doe <{}>'.format(rand.choice(addresses)),
+            'to': ', '.join(rand.sample(addresses, 2)) if i % 3 else [rand.choice(addresses), 'undisclosed'],
+            'cc': '',
+            'in_reply_to': '<{}@host.example.com>'.format(i - 1),
+            'references': ['<{}@host.example.com>'.format(j) for j in range(max(0, i - 3), i)],
+            'list_id': '<list.example.org>',
+            'date': 'Mon, 1 Jan 2001 00:00:00 +0000'
+        }
+        messages.append((text, headers))
+
+    return messages
+
+
+def _time_anonymization(anonymize, messages, repeat):
+    """
+    :param anonymize: anonymization function
+    :param messages: list of (message text, headers)
+    :param repeat: number of timed runs
+    :return: best run time in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        for text, headers in messages:
+            anonymize(text, headers)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+@click.command()
+@click.argument('input-file', type=click.File('r'))
+@click.option('-n', '--num-messages', help='Number of synthetic messages', type=int, default=5000)
+@click.option('-a', '--num-addresses', help='Number of distinct email addresses', type=int, default=2000)
+@click.option('-r', '--repeat', help='Number of timed runs (best run is reported)', type=int, default=3)
+def main(input_file, num_messages, num_addresses, repeat):
+    """
+    Benchmark email anonymization throughput of the message index annotator.
+
+    Synthetic messages with headers are built from the message texts in a JSONL file
+    (e.g., annotations/annotations-final-validation.jsonl). The output of the anonymizer is
+    checked against the original implementation before throughputs are measured.
+
+    Arguments:
+        input_file: JSONL file with a "text" field
+    """
+    # Do not log headers without email address
+    logging.disable(logging.WARNING)
+
+    messages = _generate_messages([json.loads(l)['text'] for l in input_file], num_messages, num_addresses)
+
+    anonymizer = EmailAnonymizer()
+    for text, headers in messages:
+        if _reference_anonymize(text, copy.deepcopy(headers)) != anonymizer.anonymize_message(text, headers):
+            click.echo('Anonymizer output differs from the original implementation.', err=True)
+            sys.exit(1)
+
+    # The memo of the anonymizer is already filled by the check above, like in a long-running worker
+    times = {
+        'original': _time_anonymization(_reference_anonymize, messages, repeat),
+        'EmailAnonymizer': _time_anonymization(anonymizer.anonymize_message, messages, repeat)
+    }
+    for name, seconds in times.items():
+        click.echo('{:>16}: {:.0f} messages/s'.format(name, num_messages / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,8 +18,8 @@ logger = util.get_logger(__name__)
 @click.command()
 @click.argument('index')
 @click.argument('output_directory')
-@click.option('-s', '--scroll-slices', help='Number of Elasticsearch scroll slices.', type=int, default=400)
-@click.option('-x', '--scroll-size', help='Scroll size', type=int, default=400)
+@click.option('-s', '--scroll-slices', help='Number of index slices (id_hash ranges).', type=int, default=400)
+@click.option('-x', '--scroll-size', help='Number of documents per search request', type=int, default=400)
 @click.option('-p', '--partitions', help='Number of output partitions (must be <= --scroll-slices).',
               type=int, default=250)
 def main(index, output_directory, scroll_slices, scroll_size, partitions):
@@ -47,43 +47,31 @@ def main(index, output_directory, scroll_slices, scroll_size, partitions):
 
 
 def _retrieve_messages(slice_id, max_slices, scroll_size, index):
-    logger.info('Retrieving initial batch (slice {}/{})'.format(slice_id, max_slices))
     es = util.get_es_client()
-    results = util.es_retry(
-        es.search, index=index, scroll='3h', request_timeout=360, size=scroll_size, body={
-            "query": {
-                "bool": {
-                    "must": [
-                        {"range": {"annotation_version": {"gte": ANNOTATION_VERSION}}},
-                        {"wildcard": {"group": "gmane.*"}}
-                    ]
-                }
-            },
-            "sort": ["group", "headers.date"],
-            "_source": ["group", "lang", "headers", "text_plain", "segments"],
-            "slice": {
-                "id": slice_id,
-                "max": max_slices,
-                "field": "id_hash"
+    id_range = util.get_id_hash_range(slice_id, max_slices)
+    query = {
+        "query": {
+            "bool": {
+                "must": [
+                    {"range": {"annotation_version": {"gte": ANNOTATION_VERSION}}},
+                    {"wildcard": {"group": "gmane.*"}}
+                ],
+                "filter": [{"range": {"id_hash": id_range}}] if id_range else []
             }
-        })
-
-    try:
-        while results['hits']['hits']:
-            batch = results['hits']['hits']
-
-            for doc in batch:
-                out_doc = doc['_source'].copy()
-                out_doc['headers'] = {k: v for k, v in out_doc['headers'].items()if v and k in (
-                    'date', 'message_id', 'from', 'to', 'cc', 'in_reply_to', 'references', 'subject', 'list_id'
-                )}
-                yield doc['_id'], out_doc
-
-            logger.info('Retrieving next batch (slice {}/{})'.format(slice_id, max_slices))
-            results = util.es_retry(es.scroll, scroll_id=results['_scroll_id'], scroll='3h', request_timeout=360)
-
-    finally:
-        es.clear_scroll(scroll_id=results['_scroll_id'])
+        },
+        # id_hash and warc_id make the sort order total, so that page requests can be retried safely
+        "sort": ["group", "headers.date", "id_hash", "warc_id"],
+        "_source": ["group", "lang", "headers", "text_plain", "segments"]
+    }
+
+    logger.info('Retrieving messages (slice {}/{})'.format(slice_id, max_slices))
+    for batch in util.es_search_after(es, index, query, size=scroll_size, request_timeout=360):
+        for doc in batch:
+            out_doc = doc['_source'].copy()
+            out_doc['headers'] = {k: v for k, v in out_doc['headers'].items()if v and k in (
+                'date', 'message_id', 'from', 'to', 'cc', 'in_reply_to', 'references', 'subject', 'list_id'
+            )}
+            yield doc['_id'], out_doc
 
 
 def _write_to_gzip_files(part_id, batch, output_dir):
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+from functools import partial
+import itertools
+
+import click
+from elasticsearch import ConnectionTimeout
+
+from util import util
+from util.bulk_writer import BulkWriter
+
+
+logger = util.get_logger(__name__)
+
+
+@click.command()
+@click.argument('index')
+@click.option('-s', '--scroll-slices', help='Number of Elasticsearch scroll slices', type=int, default=100)
+@click.option('-x', '--scroll-size', help='Scroll size', type=int, default=2000)
+@click.option('-n', '--dry-run', help='Dry run (do not update anything)', is_flag=True)
+def main(index, scroll_slices, scroll_size, dry_run):
+    """
+    Recompute the id_hash field of all documents in an existing message index.
+
+    Older versions of the WARC indexer used Python's randomized string hash, which made id_hash
+    differ between executors and runs and resulted in badly balanced scroll slices. This tool
+    replaces id_hash with a deterministic hash of the document ID in place.
+
+    Arguments:
+        index: Elasticsearch index
+    """
+    if dry_run:
+        logger.warning('Started in dry run mode, nothing will be updated.')
+
+    es = util.get_es_client()
+    if not es.indices.exists(index=index):
+        raise click.UsageError('Index has to exist.')
+
+    sc = util.get_spark_context('Message ID Hash Backfill', 'ID hash backfill for {}'.format(index),
+                                additional_conf={'spark.default.parallelism': scroll_slices})
+    counter = sc.accumulator(0)
+    rdd = sc.range(0, scroll_slices)
+    rdd = rdd.repartition(scroll_slices)
+    rdd.foreach(partial(_backfill_slice, index=index, max_slices=scroll_slices, scroll_size=scroll_size,
+                        counter=counter, dry_run=dry_run))
+
+    logger.info('Updated {} documents.'.format(counter.value))
+
+
+def _backfill_slice(slice_id, index, max_slices, scroll_size, counter, dry_run=False, max_restarts=10):
+    """
+    Recompute id_hash for all documents in one scroll slice.
+
+    The id_hash values being rewritten cannot serve as a search_after sort key, so the slice is scrolled.
+    Scroll requests cannot be retried after a timeout, so the slice is scanned again from the start instead.
+    Documents whose id_hash was already updated are skipped, so a restarted slice only sends the remaining updates.
+
+    :param slice_id: scroll slice ID
+    :param index: Elasticsearch index
+    :param max_slices: total number of scroll slices
+    :param scroll_size: scroll size
+    :param counter: Spark counter of updated documents
+    :param dry_run: do not send any updates
+    :param max_restarts: maximum number of times to restart the slice after a scroll timeout
+    """
+    es = util.get_es_client()
+    writer = BulkWriter(es, name='slice {}/{}'.format(slice_id, max_slices))
+
+    try:
+        for restart in itertools.count():
+            try:
+                _scroll_slice(es, writer, slice_id, index, max_slices, scroll_size, counter, dry_run)
+                return
+            except ConnectionTimeout as e:
+                if restart >= max_restarts:
+                    raise
+                logger.warning('Scroll timed out ({}), restarting slice {}/{} (restart {}/{})'.format(
+                    e, slice_id, max_slices, restart + 1, max_restarts))
+    finally:
+        writer.log_stats()
+
+
+def _scroll_slice(es, writer, slice_id, index, max_slices, scroll_size, counter, dry_run):
+    """
+    Scroll over one slice and send updates for all documents whose id_hash is out of date.
+
+    :param es: Elasticsearch client
+    :param writer: :class:`util.bulk_writer.BulkWriter` for sending updates
+    :raise ConnectionTimeout: if a scroll request timed out
+
+    Other Args:
+        See :func:`_backfill_slice`
+    """
+    logger.info('Retrieving initial batch (slice {}/{})'.format(slice_id, max_slices))
+
+    # Slice on the default _id field, since the existing id_hash values are what we want to replace
+    results = util.es_retry(es.search, index=index, scroll='45m', size=scroll_size, body={
+        'sort': ['_doc'],
+        '_source': ['id_hash'],
+        'slice': {
+            'id': slice_id,
+            'max': max_slices
+        },
+        'query': {
+            'match_all': {}
+        }
+    })
+
+    try:
+        while results['hits']['hits']:
+            actions = _generate_updates(results['hits']['hits'], index)
+            try:
+                # only start bulk request if generator has at least one element
+                peek = next(actions)
+                actions = itertools.chain([peek], actions)
+                if dry_run:
+                    num_updated = sum(1 for _ in actions)
+                else:
+                    num_updated, _ = writer.write(actions)
+                counter.add(num_updated)
+            except StopIteration:
+                pass
+
+            logger.info('Retrieving next batch (slice {}/{})'.format(slice_id, max_slices))
+            results = util.es_retry(es.scroll, scroll_id=results['_scroll_id'], scroll='45m',
+                                    policy=util.SCROLL_RETRY_POLICY)
+    finally:
+        es.clear_scroll(scroll_id=results['_scroll_id'])
+
+
+def _generate_updates(batch, index):
+    """
+    Generate partial update actions for documents whose id_hash is out of date.
+
+    :param batch: batch of documents
+    :param index: Elasticsearch index
+    :return: Generator of update actions
+    """
+    for doc in batch:
+        id_hash = util.stable_hash(doc['_id'])
+        if doc.get('_source', {}).get('id_hash') == id_hash:
+            continue
+
+        yield {
+            '_op_type': 'update',
+            '_index': index,
+            '_type': 'message',
+            '_id': doc['_id'],
+            'doc': {'id_hash': id_hash}
+        }
+
+
+if __name__ == '__main__':
+    main()
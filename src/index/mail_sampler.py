@@ -20,7 +20,7 @@ logger = util.get_logger(__name__)
 @click.option('-n', '--total-mails', help='Total number of mails to sample', type=int, default=1000)
 @click.option('-l', '--group-limit', help='Group sample limit', type=int)
 @click.option('-s', '--skip', help='Skip ahead n messages', type=int, default=0)
-@click.option('-x', '--scroll-size', help='Scroll size', type=int, default=2000)
+@click.option('-x', '--scroll-size', help='Number of documents per search request', type=int, default=2000)
 def main(index, output_file, **kwargs):
     """
     Sample mails from Elasticsearch index.
@@ -80,9 +80,14 @@ def main(index, output_file, **kwargs):
             }
         }
 
+    # Page through results with search_after, which needs a total sort order
+    sort = query.setdefault('sort', [])
+    if 'warc_id' not in [f if type(f) is str else next(iter(f)) for f in sort]:
+        sort.append('warc_id')
+
     logger.info('Retrieving initial batch')
     es = util.get_es_client()
-    results = util.es_retry(es.search, index=index, scroll='10m', size=kwargs['scroll_size'], body=query)
+    hits = (h for page in util.es_search_after(es, index, query, size=kwargs['scroll_size']) for h in page)
 
     skip = kwargs['skip']
     if skip > 0:
@@ -92,50 +97,44 @@ def main(index, output_file, **kwargs):
     num_samples = 0
     num_skipped = 0
 
-    try:
-        with tqdm(desc='Calculating progress', unit=' messages') as progress_bar:
-            while num_samples < kwargs['total_mails'] and len(results['hits']['hits']) > 0:
-                for hit in results['hits']['hits']:
-                    if skip > 0 and num_skipped < skip:
-                        progress_bar.set_description('Skipping messages')
-                        progress_bar.total = skip
-                        num_skipped += 1
-                        progress_bar.update()
-                        continue
-                    elif (skip == 0 or num_skipped >= skip) and num_samples == 0:
-                        progress_bar.set_description('Sampling messages')
-                        progress_bar.total = kwargs['total_mails']
-                        progress_bar.n = 0
-                        progress_bar.last_print_n = 0
-                        progress_bar.update(0)
-
-                    src = hit['_source']
-                    text_plain = src['text_plain']
-
-                    prev_samples = sampled_groups.get(src['group'], 0)
-                    if kwargs['group_limit'] and prev_samples > kwargs['group_limit']:
-                        continue
-                    sampled_groups[src['group']] = prev_samples + 1
-
-                    num_samples += 1
-                    progress_bar.update()
-
-                    if output_jsonl:
-                        json.dump({'text': text_plain,
-                                   'meta': {k: src[k] for k in src.keys() if k not in ['text_plain', 'text_html']},
-                                   'labels': []}, output_jsonl)
-                        output_jsonl.write('\n')
-
-                    if output_text:
-                        output_text.write(util.normalize_message_text(text_plain))
-                        output_text.write('\n')
-
-                    if num_samples >= kwargs['total_mails']:
-                        break
-
-                results = util.es_retry(es.scroll, scroll_id=results['_scroll_id'], scroll='10m')
-    finally:
-        es.clear_scroll(scroll_id=results['_scroll_id'])
+    with tqdm(desc='Calculating progress', unit=' messages') as progress_bar:
+        for hit in hits:
+            if skip > 0 and num_skipped < skip:
+                progress_bar.set_description('Skipping messages')
+                progress_bar.total = skip
+                num_skipped += 1
+                progress_bar.update()
+                continue
+            elif (skip == 0 or num_skipped >= skip) and num_samples == 0:
+                progress_bar.set_description('Sampling messages')
+                progress_bar.total = kwargs['total_mails']
+                progress_bar.n = 0
+                progress_bar.last_print_n = 0
+                progress_bar.update(0)
+
+            src = hit['_source']
+            text_plain = src['text_plain']
+
+            prev_samples = sampled_groups.get(src['group'], 0)
+            if kwargs['group_limit'] and prev_samples > kwargs['group_limit']:
+                continue
+            sampled_groups[src['group']] = prev_samples + 1
+
+            num_samples += 1
+            progress_bar.update()
+
+            if output_jsonl:
+                json.dump({'text': text_plain,
+                           'meta': {k: src[k] for k in src.keys() if k not in ['text_plain', 'text_html']},
+                           'labels': []}, output_jsonl)
+                output_jsonl.write('\n')
+
+            if output_text:
+                output_text.write(util.normalize_message_text(text_plain))
+                output_text.write('\n')
+
+            if num_samples >= kwargs['total_mails']:
+                break
 
     if output_jsonl:
         output_jsonl.close()
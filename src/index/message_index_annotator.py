@@ -1,40 +1,54 @@
 #!/usr/bin/env python3
 
-from base64 import b64encode
 from collections import defaultdict
-import itertools
 from functools import partial
-from hashlib import sha256
 import os
 import re
-import site
-import sys
 from time import time
 
 import click
-from elasticsearch import helpers
-import spacy
-from spacy_langdetect import LanguageDetector
-from tensorflow.keras import models
+import numpy as np
 from tqdm import tqdm
 
-from parsing.message_segmenter import load_fasttext_model, predict_raw_text
+from parsing.message_segmenter import CONTEXT_SHAPE, load_fasttext_model, predict_batch, MessageSegmenter
 from util import mail_classification, util
+from util.annotation_cache import AnnotationCache
+from util.anonymization import EmailAnonymizer
+from util.bulk_writer import BulkWriter
+from util.language_detection import get_language_detector, LANGUAGE_DETECTOR_BACKENDS
 
 
-ANNOTATION_VERSION = 11
+ANNOTATION_VERSION = 12
 
 logger = util.get_logger(__name__)
 
+# Email anonymizer with address memo shared by all batches of a worker
+_anonymizer = EmailAnonymizer()
+
 
 @click.command()
 @click.argument('index')
 @click.argument('segmentation_model', type=click.Path(exists=True, dir_okay=False))
 @click.argument('fasttext_model', type=click.Path(exists=True, dir_okay=False))
-@click.option('-s', '--scroll-slices', help='Number of Elasticsearch scroll slices', type=int, default=200)
-@click.option('-x', '--scroll-size', help='Scroll size', type=int, default=150)
+@click.option('-s', '--scroll-slices', help='Number of index slices (id_hash ranges)', type=int, default=200)
+@click.option('-x', '--scroll-size', help='Number of documents per search request', type=int, default=150)
 @click.option('-n', '--dry-run', help='Dry run (do not index anything)', is_flag=True)
 @click.option('-a', '--anonymize', help='Anonymize email addresses', is_flag=True)
+@click.option('-l', '--line-cache-size', help='Number of lines whose word vectors are cached per worker',
+              type=int, default=20000)
+@click.option('-g', '--lang-detector', help='Language detection backend', type=click.Choice(LANGUAGE_DETECTOR_BACKENDS),
+              default='langdetect')
+@click.option('-m', '--lang-model', help='fastText language identification model (e.g., lid.176.bin) '
+                                          'for the fasttext language detector', type=click.Path(dir_okay=False))
+@click.option('-c', '--chunk-size', help='Maximum number of documents per bulk request', type=int, default=500)
+@click.option('-w', '--embedding-workers', help='Number of processes per worker for embedding message lines '
+                                                 '(0: embed in the inference thread)', type=int, default=0)
+@click.option('-d', '--dedup-cache', help='SQLite file for caching annotations of identical message texts '
+                                           '(local to each executor)', type=click.Path(dir_okay=False))
+@click.option('-q', '--queue-size', help='Number of batches buffered between fetch, segmentation and indexing stages',
+              type=int, default=2)
+@click.option('-k', '--checkpoint-index', help='Elasticsearch index for slice checkpoints '
+                                                '(default: <index>-annotation-checkpoints)')
 def main(index, segmentation_model, fasttext_model, **kwargs):
     """
     Automatic message index annotation tool.
@@ -42,11 +56,17 @@ def main(index, segmentation_model, fasttext_model, **kwargs):
     Automatically annotates an existing message index by scrolling through all messages,
     analyzing them, and updating the index documents with the generated annotations.
 
+    Each slice worker pages through its id_hash range with search_after and stores its
+    position after every indexed batch, so restarted workers resume where they stopped.
+    Fetching, segmentation and indexing run in separate threads, so network I/O overlaps with inference.
+
     Arguments:
         index: the Elasticsearch index
         segmentation_model: pre-trained HDF5 email segmentation model
         fasttext_model: pre-trained FastText embedding
     """
+    if kwargs['lang_detector'] == 'fasttext' and not kwargs.get('lang_model'):
+        raise click.UsageError('--lang-model is required for the fasttext language detector.')
 
     start_indexer(index, segmentation_model, fasttext_model, **kwargs)
 
@@ -62,6 +82,9 @@ def start_indexer(index, segmentation_model, fasttext_model, **kwargs):
     Keyword Args:
         dry_run (bool): Perform dry run, do not actually index anything
         progress_bar (bool): Show indexing progress bar
+        checkpoint_index (str): Elasticsearch index for slice checkpoints
+        lang_detector (str): language detection backend
+        lang_model (str): fastText language identification model (for the ``fasttext`` backend)
     """
 
     if kwargs.get('dry_run'):
@@ -120,6 +143,26 @@ def start_indexer(index, segmentation_model, fasttext_model, **kwargs):
         ]
     })
 
+    checkpoint_index = _get_checkpoint_index(index, kwargs.get('checkpoint_index'))
+    if not es.indices.exists(index=checkpoint_index):
+        es.indices.create(index=checkpoint_index, body={
+            "settings": {
+                "number_of_replicas": 0,
+                "number_of_shards": 1
+            },
+            "mappings": {
+                "properties": {
+                    "annotation_version": {"type": "short"},
+                    "slice_id": {"type": "integer"},
+                    "max_slices": {"type": "integer"},
+                    "last_id_hash": {"type": "long"},
+                    "last_warc_id": {"type": "keyword"},
+                    "done": {"type": "boolean"},
+                    "modified": {"type": "date", "format": "epoch_millis"}
+                }
+            }
+        })
+
     slices = kwargs.get('scroll_slices', 2)
     sc = util.get_spark_context('Mail Annotation Indexer', additional_conf={'spark.default.parallelism': slices})
     rdd = sc.range(0, slices)
@@ -132,75 +175,169 @@ def _start_spark_worker(slice_id, index, segmentation_model, fasttext_model, **k
     # Fix to circumvent Yarn's buggy HOME override
     os.environ['HOME'] = os.environ.get('HADOOP_HOME', os.environ['HOME'])
 
-    logger.info('Loading SpaCy')
-    if not spacy.util.is_package('en_core_web_sm'):
-        oldbase = site.USER_BASE
-        site.USER_BASE = os.path.join(os.environ['HOME'], '.local')
-        site.USER_SITE = site.USER_SITE.replace(oldbase, site.USER_BASE)
-        os.makedirs(site.USER_SITE, exist_ok=True)
-        sys.path.insert(0, site.USER_SITE)
-        spacy.cli.download('en_core_web_sm')
-    import en_core_web_sm
-    nlp = en_core_web_sm.load()
-    nlp.add_pipe(LanguageDetector(), name='language_detector', last=True)
+    max_slices = kwargs.get('scroll_slices', 2)
+    es = util.get_es_client()
+    writer = BulkWriter(es, chunk_size=kwargs.get('chunk_size', 500),
+                        name='slice {}/{}'.format(slice_id, max_slices))
+    checkpoint = _SliceCheckpoint(es, _get_checkpoint_index(index, kwargs.get('checkpoint_index')),
+                                  slice_id, max_slices)
+
+    search_after = checkpoint.load()
+    if search_after is False:
+        logger.info('Slice {}/{} already finished.'.format(slice_id, max_slices))
+        return
+    if search_after is not None:
+        logger.info('Resuming slice {}/{} after {}'.format(slice_id, max_slices, search_after))
+
+    lang_backend = kwargs.get('lang_detector', 'langdetect')
+    logger.info('Loading language detector ({})'.format(lang_backend))
+    lang_detector = get_language_detector(lang_backend, model_path=kwargs.get('lang_model'))
 
     logger.info('Loading segmentation model')
     load_fasttext_model(fasttext_model)
-    segmentation_model = models.load_model(segmentation_model)
+    mail_classification.set_word_vector_cache_size(kwargs.get('line_cache_size', 20000))
 
-    max_slices = kwargs.get('scroll_slices', 2)
-    logger.info('Retrieving initial batch (slice {}/{})'.format(slice_id, max_slices))
-    es = util.get_es_client()
-    results = util.es_retry(es.search, index=index, scroll='45m', size=kwargs['scroll_size'], body={
-        'sort': ['_id'],
-        'slice': {
-            'id': slice_id,
-            'max': max_slices,
-            'field': 'id_hash'
-        },
+    # Fork embedding workers before the segmentation model and any pipeline threads are started
+    embedding_pool = None
+    if kwargs.get('embedding_workers'):
+        logger.info('Starting {} embedding workers'.format(kwargs['embedding_workers']))
+        embedding_pool = mail_classification.LineEmbeddingPool(kwargs['embedding_workers'], CONTEXT_SHAPE[1:])
+
+    segmentation_model = MessageSegmenter(segmentation_model)
+
+    dedup_cache = None
+    if kwargs.get('dedup_cache'):
+        dedup_cache = AnnotationCache(kwargs['dedup_cache'], ANNOTATION_VERSION)
+
+    id_range = util.get_id_hash_range(slice_id, max_slices)
+    query = {
+        'sort': [{'id_hash': 'asc'}, {'warc_id': 'asc'}],
         'query': {
             'bool': {
-                "must": {
-                    "wildcard": {"group": "gmane.*"}
+                'must': {
+                    'wildcard': {'group': 'gmane.*'}
                 },
+                'filter': [{'range': {'id_hash': id_range}}] if id_range else [],
                 'must_not': {
                     'range': {'annotation_version': {'gte': ANNOTATION_VERSION}}
                 }
             }
         }
-    })
+    }
+
+    dry_run = kwargs.get('dry_run', False)
+    last_indexed = [search_after]
+
+    def fetch_batches():
+        for hits in util.es_search_after(es, index, query, size=kwargs['scroll_size'], search_after=search_after):
+            logger.info('Retrieved next batch (slice {}/{})'.format(slice_id, max_slices))
+            yield hits, hits[-1]['sort']
+
+    def segment_batch(batch):
+        hits, sort_values = batch
+        logger.info('Processing batch.')
+        return list(_generate_docs(hits, index, segmentation_model, lang_detector, progress_bar=False,
+                                   anonymize=kwargs.get('anonymize', False),
+                                   embedding_pool=embedding_pool, dedup_cache=dedup_cache)), sort_values
+
+    def index_batch(batch):
+        actions, sort_values = batch
+        if not dry_run:
+            if actions:
+                writer.write(actions)
+            # Checkpoint only after the batch was indexed successfully
+            checkpoint.save(sort_values)
+        last_indexed[0] = sort_values
+        logger.info('Finished indexing batch.')
 
     try:
-        while results['hits']['hits']:
-            logger.info('Processing batch.')
-            doc_gen = _generate_docs(results['hits']['hits'], index, segmentation_model, nlp,
-                                     progress_bar=False, anonymize=kwargs.get('anonymize', False))
-            try:
-                if kwargs.get('dry_run'):
-                    while True:
-                        next(doc_gen)
-                else:
-                    # only start bulk request if generator has at least one element
-                    peek = next(doc_gen)
-                    helpers.bulk(es, itertools.chain([peek], doc_gen))
-                logger.info('Finished indexing batch.')
-            except StopIteration:
-                pass
-
-            logger.info('Retrieving next batch (slice {}/{})'.format(slice_id, max_slices))
-            results = util.es_retry(es.scroll, scroll_id=results['_scroll_id'], scroll='45m')
+        util.run_pipeline(fetch_batches(), segment_batch, index_batch, queue_size=kwargs.get('queue_size', 2))
+        if not dry_run:
+            checkpoint.save(last_indexed[0], done=True)
     finally:
-        es.clear_scroll(scroll_id=results['_scroll_id'])
+        writer.log_stats()
+        if embedding_pool is not None:
+            embedding_pool.close()
+
+        if dedup_cache is not None:
+            logger.info('Annotation cache hit rate (slice {}/{}): {:.2%} ({} hits, {} misses)'.format(
+                slice_id, max_slices, dedup_cache.hit_rate, dedup_cache.hits, dedup_cache.misses))
+            dedup_cache.close()
+
+        cache = mail_classification.get_word_vector_cache()
+        logger.info('Word vector cache hit rate (slice {}/{}): {:.2%} ({} hits, {} misses)'.format(
+            slice_id, max_slices, cache.hit_rate, cache.hits, cache.misses))
+
+
+def _get_checkpoint_index(index, checkpoint_index=None):
+    """
+    :param index: Elasticsearch message index
+    :param checkpoint_index: explicit checkpoint index name (optional)
+    :return: name of the slice checkpoint index
+    """
+    return checkpoint_index or '{}-annotation-checkpoints'.format(index)
 
 
-def _generate_docs(batch, index, segmentation_model, nlp, progress_bar=False, anonymize=False):
+class _SliceCheckpoint:
+    """
+    Last processed sort position of an annotation slice, stored in Elasticsearch.
+    """
+
+    def __init__(self, es, checkpoint_index, slice_id, max_slices):
+        """
+        :param es: Elasticsearch client
+        :param checkpoint_index: Elasticsearch checkpoint index
+        :param slice_id: slice ID
+        :param max_slices: total number of slices
+        """
+        self.es = es
+        self.checkpoint_index = checkpoint_index
+        self.slice_id = slice_id
+        self.max_slices = max_slices
+        self.checkpoint_id = '{}-{}-{}'.format(ANNOTATION_VERSION, slice_id, max_slices)
+
+    def load(self):
+        """
+        :return: search_after sort values, None if the slice has not been started, False if it is finished
+        """
+        if not util.es_retry(self.es.exists, index=self.checkpoint_index, doc_type='_doc', id=self.checkpoint_id):
+            return None
+
+        src = util.es_retry(self.es.get, index=self.checkpoint_index, doc_type='_doc', id=self.checkpoint_id)['_source']
+        if src.get('done'):
+            return False
+        if src.get('last_id_hash') is None:
+            return None
+        return [src['last_id_hash'], src['last_warc_id']]
+
+    def save(self, search_after, done=False):
+        """
+        :param search_after: sort values of the last processed document (or None)
+        :param done: whether the slice is finished
+        """
+        util.es_retry(self.es.index, index=self.checkpoint_index, doc_type='_doc', id=self.checkpoint_id, body={
+            'annotation_version': ANNOTATION_VERSION,
+            'slice_id': self.slice_id,
+            'max_slices': self.max_slices,
+            'last_id_hash': search_after[0] if search_after else None,
+            'last_warc_id': search_after[1] if search_after else None,
+            'done': done,
+            'modified': int(time() * 1000)
+        })
+
+
+def _generate_docs(batch, index, segmentation_model, lang_detector, progress_bar=False, anonymize=False,
+                   embedding_pool=None, dedup_cache=None):
     """
     Generate Elasticsearch index docs.
+    Identical message texts are annotated only once per batch and, if a cache is given, only once overall.
 
     :param batch: batch of documents
     :param index: Elasticsearch index
     :param segmentation_model: Email segmentation model
-    :param nlp: SpaCy language model
+    :param lang_detector: language detector
+    :param embedding_pool: line embedding process pool (optional)
+    :param dedup_cache: :class:`util.annotation_cache.AnnotationCache` for reusing annotations (optional)
     :return: Generator of index doc actions
 
     Keyword Args:
@@ -210,20 +347,7 @@ def _generate_docs(batch, index, segmentation_model, nlp, progress_bar=False, an
     if progress_bar:
         batch = tqdm(batch, desc='Preparing documents in batch', unit='docs', total=len(batch), leave=False)
 
-    email_regex = re.compile(r'((?:[a-zA-Z0-9_\-./+]+)@(?:(?:\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
-                             r'(?:(?:[a-zA-Z0-9\-]+\.)+))(?:[a-zA-Z]{2,}|[0-9]{1,3})(?:\]?))')
-
-    def email_replacement(e):
-        return b64encode(sha256(e.group().encode()).digest())[:16].decode() + '@example.com'
-
-    def extract_email_addr(s):
-        try:
-            return email_regex.search(s).group()
-        except (TypeError, AttributeError):
-            # Use value as is if not an email address
-            logger.warning('Expected email address in "{}", but couldn\'t find any.'.format(s))
-            return s
-
+    prepared_docs = []
     for doc in batch:
         doc_id = doc['_id']
 
@@ -243,80 +367,42 @@ def _generate_docs(batch, index, segmentation_model, nlp, progress_bar=False, an
 
         # Anonymize email addresses
         if anonymize:
-            raw_text = email_regex.sub(email_replacement, raw_text)
+            raw_text, headers = _anonymizer.anonymize_message(raw_text, src['headers'])
             output_doc['text_plain'] = raw_text
+            output_doc['headers'] = headers
 
-            src['headers'] = {k: src['headers'][k] for k in src['headers']
-                              if src['headers'][k] and k in {'message_id', 'subject', 'from', 'to', 'cc',
-                                                             'in_reply_to', 'references', 'list_id'}}
-            for h in src['headers']:
-                # Keep only email address in certain headers
-                if h in {'cc', 'to'}:
-                    if type(src['headers'][h]) is not list:
-                        src['headers'][h] = [src['headers'][h]]
-                    src['headers'][h] = [extract_email_addr(x) for x in src['headers'][h]]
-                elif h in {'from', 'from_email', 'in_reply_to'}:
-                    src['headers'][h] = extract_email_addr(src['headers'][h])
-
-                if type(src['headers'][h]) is list:
-                    src['headers'][h] = [email_regex.sub(email_replacement, x) for x in src['headers'][h]]
-                elif h != 'list_id':
-                    src['headers'][h] = email_regex.sub(email_replacement, src['headers'][h])
-
-            output_doc['headers'] = src['headers']
-
-        stats = defaultdict(lambda: {'num': 0, 'chars': 0, 'lines': 0, 'avg_len': 0.0})
-        occurrences = defaultdict(lambda: 0)
-
-        # Segment message, but  skip overly long texts to avoid running out of memory
-        if len(raw_text) <= 100000:
-            try:
-                logger.debug('Segmenting message')
-                label_gen = predict_raw_text(segmentation_model, raw_text)
-            except Exception as e:
-                logger.error('Error segmenting message: {}'.format(e))
-                label_gen = []
-
-            # Calculate segment stats and extract main content
-            logger.debug('Calculating segment stats')
-            main_content = ''
-            output_doc['segments'] = []
-            for begin, end, label in mail_classification.line_labels_to_char_pos(label_gen):
-                if label in ['paragraph', 'section_heading']:
-                    main_content += raw_text[begin:end]
-
-                stats[label]['num'] += 1
-                stats[label]['chars'] += end - begin
-                stats[label]['lines'] += raw_text[begin:end].count('\n')
-                occurrences[label] += 1
-
-                output_doc['segments'].append({'begin': begin, 'end': end, 'label': label})
-
-            # Collapse newlines to a maximum of two
-            main_content = re.sub(r'\n{3,}', '\n\n', main_content).rstrip()
-
-            output_doc['main_content'] = main_content
-
-            for label in stats:
-                stats[label]['avg_len'] = stats[label]['chars'] / occurrences[label]
-
-            stats['paragraph_quotation'] = {
-                'num_ratio': (stats['paragraph']['num'] / stats['quotation']['num'])
-                if stats['quotation']['num'] > 0 else -1,
-
-                'lines_ratio': (stats['paragraph']['lines'] / stats['quotation']['lines'])
-                if stats['quotation']['lines'] > 0 else -1,
-            }
+        prepared_docs.append((doc_id, raw_text, output_doc))
+
+    # Annotate each distinct message text only once
+    texts = {}
+    for _, raw_text, _ in prepared_docs:
+        texts.setdefault(AnnotationCache.get_text_hash(raw_text), raw_text)
+
+    annotations = dedup_cache.get_many(list(texts)) if dedup_cache is not None else {}
+    missing = [h for h in texts if h not in annotations]
+
+    # Segment all remaining messages of the batch at once
+    logger.debug('Segmenting messages')
+    predictions = _segment_messages(segmentation_model, [texts[h] for h in missing], embedding_pool)
+    new_annotations = {h: _annotate_message(texts[h], p if p is not None else [])
+                       for h, p in zip(missing, predictions)}
 
-            output_doc['label_stats'] = dict(stats)
+    # Improve language prediction by making use of content segmentation
+    logger.debug('Detecting languages')
+    lang_annotations = [a for a in new_annotations.values() if len(a['main_content']) > 15]
+    langs = lang_detector.detect_batch([a['main_content'] for a in lang_annotations])
+    for a, lang in zip(lang_annotations, langs):
+        a['lang'] = lang if lang is not None else 'UNKNOWN'
 
-            # Improve language prediction by making use of content segmentation
-            if len(main_content) > 15:
-                logger.debug('Detecting language')
-                output_doc['lang'] = nlp(main_content)._.language['language']
-        else:
-            logger.warning('Skipped overly long message ({} bytes).'.format(len(raw_text)))
+    if dedup_cache is not None:
+        # Do not cache messages that could not be segmented
+        dedup_cache.put_many({h: new_annotations[h] for h, p in zip(missing, predictions) if p is not None})
+    annotations.update(new_annotations)
 
+    for _, raw_text, output_doc in prepared_docs:
+        output_doc.update(annotations[AnnotationCache.get_text_hash(raw_text)])
+
+    for doc_id, _, output_doc in prepared_docs:
         output_doc['annotation_version'] = ANNOTATION_VERSION
         output_doc['modified'] = int(time() * 1000)
 
@@ -329,5 +415,107 @@ def _generate_docs(batch, index, segmentation_model, nlp, progress_bar=False, an
         }
 
 
+def _get_segments(raw_text, label_gen):
+    """
+    Calculate segment boundaries and line counts from line predictions.
+
+    Segments are the same as those of :func:`util.mail_classification.line_labels_to_char_pos`,
+    but are computed from cumulative line lengths without slicing the message text.
+
+    :param raw_text: message text
+    :param label_gen: line predictions of the message
+    :return: arrays of segment begin offsets, end offsets and line counts, and list of segment labels
+    """
+    num_lines = len(label_gen)
+    line_ends = np.cumsum(np.fromiter((len(l) for l, _ in label_gen), dtype=np.int64, count=num_lines))
+    total = int(line_ends[-1]) if num_lines else 0
+
+    # Lines end with a newline, except for the last line if it reaches past the end of the message text
+    newlines = np.concatenate(([0], np.cumsum(line_ends <= len(raw_text))))
+
+    is_content = np.fromiter((l not in ('<empty>', '<pad>') for _, l in label_gen), dtype=bool, count=num_lines)
+    content_idx = np.flatnonzero(is_content)
+    if len(content_idx) == 0:
+        return np.array([0]), np.array([total]), newlines[-1:], [None]
+
+    # Segments start at lines whose label differs from that of the previous non-empty line,
+    # empty lines are added to the preceding segment (or the first one)
+    content_labels = [label_gen[i][1] for i in content_idx]
+    starts = [0] + [i for i in range(1, len(content_idx)) if content_labels[i] != content_labels[i - 1]]
+    first_lines = np.concatenate(([0], content_idx[starts[1:]], [num_lines]))
+    labels = [content_labels[i] for i in starts]
+
+    line_begins = np.concatenate(([0], line_ends))
+    begins = line_begins[first_lines[:-1]]
+    ends = line_begins[first_lines[1:]]
+    line_counts = newlines[first_lines[1:]] - newlines[first_lines[:-1]]
+
+    return begins, ends, line_counts, labels
+
+
+def _annotate_message(raw_text, label_gen):
+    """
+    Calculate segments, segment stats and main content of a message.
+
+    :param raw_text: message text
+    :param label_gen: line predictions of the message
+    :return: dict with segments, main content and label stats
+    """
+    logger.debug('Calculating segment stats')
+    begins, ends, line_counts, labels = _get_segments(raw_text, list(label_gen))
+    begins, ends, line_counts = begins.tolist(), ends.tolist(), line_counts.tolist()
+
+    main_content = ''.join(raw_text[b:e] for b, e, l in zip(begins, ends, labels)
+                           if l in ['paragraph', 'section_heading'])
+    # Collapse newlines to a maximum of two
+    main_content = re.sub(r'\n{3,}', '\n\n', main_content).rstrip()
+
+    stats = defaultdict(lambda: {'num': 0, 'chars': 0, 'lines': 0, 'avg_len': 0.0})
+    for b, e, n, l in zip(begins, ends, line_counts, labels):
+        stats[l]['num'] += 1
+        stats[l]['chars'] += e - b
+        stats[l]['lines'] += n
+    for label in stats:
+        stats[label]['avg_len'] = stats[label]['chars'] / stats[label]['num']
+
+    stats['paragraph_quotation'] = {
+        'num_ratio': (stats['paragraph']['num'] / stats['quotation']['num'])
+        if stats['quotation']['num'] > 0 else -1,
+
+        'lines_ratio': (stats['paragraph']['lines'] / stats['quotation']['lines'])
+        if stats['quotation']['lines'] > 0 else -1,
+    }
+
+    return {
+        'segments': [{'begin': b, 'end': e, 'label': l} for b, e, l in zip(begins, ends, labels)],
+        'main_content': main_content,
+        'label_stats': dict(stats)
+    }
+
+
+def _segment_messages(segmentation_model, messages, embedding_pool=None):
+    """
+    Segment a batch of messages, falling back to segmenting them one by one if the batch fails.
+
+    :param segmentation_model: Email segmentation model
+    :param messages: list of message texts
+    :param embedding_pool: line embedding process pool (optional)
+    :return: list of line predictions, one for each message (None if the message could not be segmented)
+    """
+    try:
+        return predict_batch(segmentation_model, messages, embedding_pool=embedding_pool)
+    except Exception as e:
+        logger.error('Error segmenting batch: {}'.format(e))
+
+    predictions = []
+    for message in messages:
+        try:
+            predictions.append(predict_batch(segmentation_model, [message], embedding_pool=embedding_pool)[0])
+        except Exception as e:
+            logger.error('Error segmenting message: {}'.format(e))
+            predictions.append(None)
+    return predictions
+
+
 if __name__ == '__main__':
     main()
@@ -7,24 +7,54 @@ import re
 from time import time
 
 import click
-from elasticsearch import helpers
 import email
 import email.utils
 import pytz
-import spacy
-from spacy_langdetect import LanguageDetector
 from warcio import ArchiveIterator
 
 from util import util
+from util.bulk_writer import BulkWriter
+from util.language_detection import get_language_detector, LANGUAGE_DETECTOR_BACKENDS
 
 
 logger = util.get_logger(__name__)
 
+# Message headers stored in the index
+INDEXED_HEADERS = ('from', 'date', 'message-id', 'subject', 'to', 'cc', 'in-reply-to', 'references', 'list-id')
+
+_email_regex = re.compile(r'((?:[a-zA-Z0-9_\-./+]+)@(?:(?:\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
+                          r'(?:(?:[a-zA-Z0-9\-]+\.)+))(?:[a-zA-Z]{2,}|[0-9]{1,3})(?:\]?))')
+_comma_regex = re.compile(r',')
+_whitespace_regex = re.compile(r'\s')
+_whitespace_seq_regex = re.compile(r'\s+')
+
+# Update script which overwrites all fields of an existing document, except for an already detected language
+_UPDATE_SCRIPT = '''
+def lang = ctx._source.lang;
+ctx._source.putAll(params.doc);
+if (lang != null) {
+    ctx._source.lang = lang;
+}
+'''
+
 
 @click.command()
 @click.argument('input-dir', type=click.Path(exists=True, file_okay=False))
 @click.argument('index')
-def main(input_dir, index):
+@click.option('-l', '--lang-detector', help='Language detection backend', type=click.Choice(LANGUAGE_DETECTOR_BACKENDS),
+              default='langdetect')
+@click.option('-L', '--lang-model', help='fastText language identification model (e.g., lid.176.bin) '
+                                          'for the fasttext language detector', type=click.Path(dir_okay=False))
+@click.option('-m', '--bulk-mode', help='Bulk action type (auto: index if the index is new, update otherwise)',
+              type=click.Choice(['auto', 'index', 'update']), default='auto')
+@click.option('-c', '--chunk-size', help='Number of documents per bulk request', type=int, default=500)
+@click.option('-b', '--max-chunk-bytes', help='Maximum size of a bulk request in bytes', type=int,
+              default=100 * 1024 * 1024)
+@click.option('-t', '--bulk-threads', help='Number of parallel bulk request threads per worker', type=int, default=1)
+@click.option('-s', '--skip-html', help='Do not store text/html message parts', is_flag=True)
+@click.option('-f', '--full', help='Reindex all WARC files, including those already recorded in the manifest',
+              is_flag=True)
+def main(input_dir, index, **kwargs):
     """
     Index WARC files containing email/newsgroup messages to Elasticsearch.
 
@@ -32,21 +62,48 @@ def main(input_dir, index):
         input_dir: input directory containing raw WARC files
         index: Elasticsearch index
     """
-    index_directory(input_dir, index)
+    if kwargs['lang_detector'] == 'fasttext' and not kwargs.get('lang_model'):
+        raise click.UsageError('--lang-model is required for the fasttext language detector.')
 
+    index_directory(input_dir, index, **kwargs)
 
-def index_directory(input_dir, index):
+
+def index_directory(input_dir, index, lang_detector='langdetect', lang_model=None, bulk_mode='auto', chunk_size=500,
+                    max_chunk_bytes=100 * 1024 * 1024, bulk_threads=1, skip_html=False, full=False):
     """
     Index WARC files from the given directory.
 
+    Successfully indexed WARC files are recorded in a manifest index (``<index>-manifest``)
+    together with their size and modification time. Unless ``full`` is set, WARC files
+    whose manifest entry is still up to date are skipped, so interrupted or incremental
+    runs only process new or changed files.
+
+    In ``index`` mode, existing documents are replaced completely. In ``update`` mode, the fields of existing
+    documents are overwritten, but a previously detected language is kept (documents without one get the
+    newly detected language). ``auto`` uses ``index`` mode if the index does not exist yet and ``update`` mode
+    otherwise.
+
     :param input_dir: input directory containing raw WARC files
     :param index: Elasticsearch index
+    :param lang_detector: language detection backend
+    :param lang_model: fastText language identification model (for the ``fasttext`` backend)
+    :param bulk_mode: bulk action type (``auto``, ``index`` or ``update``)
+    :param chunk_size: number of documents per bulk request
+    :param max_chunk_bytes: maximum size of a bulk request in bytes
+    :param bulk_threads: number of parallel bulk request threads per worker
+    :param skip_html: do not store text/html message parts
+    :param full: ignore manifest and reindex all WARC files
     """
 
     es = util.get_es_client()
     sc = util.get_spark_context('Mail WARC Indexer', 'Mail WARC Indexer for {}'.format(input_dir))
 
-    if not es.indices.exists(index=index):
+    index_exists = es.indices.exists(index=index)
+    if bulk_mode == 'auto':
+        bulk_mode = 'update' if index_exists else 'index'
+    logger.info('Using bulk mode "{}"'.format(bulk_mode))
+
+    if not index_exists:
         es.indices.create(index=index, body={
             "settings": {
                 "number_of_replicas": 0,
@@ -73,6 +130,33 @@ def index_directory(input_dir, index):
             }
         })
 
+    manifest_index = _get_manifest_index(index)
+    if not es.indices.exists(index=manifest_index):
+        es.indices.create(index=manifest_index, body={
+            "settings": {
+                "number_of_replicas": 0,
+                "number_of_shards": 1
+            },
+            "mappings": {
+                "properties": {
+                    "path": {"type": "keyword"},
+                    "size": {"type": "long"},
+                    "mtime": {"type": "date", "format": "epoch_millis"},
+                    "record_count": {"type": "long"},
+                    "modified": {"type": "date", "format": "epoch_millis"}
+                }
+            }
+        })
+
+    # A manifest of a previously deleted index is meaningless
+    manifest = {}
+    if full or not index_exists:
+        logger.info('Ignoring manifest, indexing all WARCs')
+    else:
+        logger.info('Loading manifest')
+        manifest = {m['_id']: (m['_source']['size'], m['_source']['mtime'])
+                    for m in util.es_scan(es, index=manifest_index, body={'_source': ['size', 'mtime']})}
+
     counter = sc.accumulator(0)
 
     logger.info("Listing group directories")
@@ -81,64 +165,206 @@ def index_directory(input_dir, index):
 
     logger.info('Listing WARCS')
     warcs = group_dirs.flatMap(lambda d: glob(os.path.join(d, '*.warc.gz')))
+    warcs = warcs.map(_get_warc_stat)
+    if manifest:
+        manifest = sc.broadcast(manifest)
+        warcs = warcs.filter(lambda w: manifest.value.get(_get_warc_path(w[0])) != (w[1], w[2]))
     warcs.cache()
+    logger.info('Found {} new or changed WARCs'.format(warcs.count()))
 
     logger.info('Indexing messages')
-    warcs.foreach(partial(_index_warc, index=index, counter=counter))
+    bulk_options = {'chunk_size': chunk_size, 'max_chunk_bytes': max_chunk_bytes, 'thread_count': bulk_threads}
+    warcs.foreachPartition(partial(_index_warcs, index=index, counter=counter, lang_detector=lang_detector,
+                                   lang_model=lang_model, bulk_mode=bulk_mode, bulk_options=bulk_options,
+                                   skip_html=skip_html))
 
 
-def _index_warc(filename, index, counter):
+def _get_manifest_index(index):
+    """
+    :param index: Elasticsearch message index
+    :return: name of the manifest index of processed WARC files
+    """
+    return '{}-manifest'.format(index)
+
+
+def _get_warc_path(filename):
+    """
+    :param filename: WARC file name
+    :return: WARC path relative to the input directory (group/file name)
+    """
+    return os.path.join(os.path.basename(os.path.dirname(filename)), os.path.basename(filename))
+
+
+def _get_warc_stat(filename):
+    """
+    :param filename: WARC file name
+    :return: tuple of file name, size in bytes and modification time in milliseconds
+    """
+    stat = os.stat(filename)
+    return filename, stat.st_size, int(stat.st_mtime * 1000)
+
+
+def _index_warcs(warcs, index, counter, lang_detector, lang_model, bulk_mode, bulk_options, skip_html=False):
+    """
+    Index a partition of WARC files with a shared language detector and Elasticsearch client.
+    Each successfully indexed WARC file is recorded in the manifest index.
+
+    :param warcs: iterable of WARC file name, size and modification time tuples
+    :param index: Elasticsearch index
+    :param counter: Spark counter
+    :param lang_detector: language detection backend
+    :param lang_model: fastText language identification model (for the ``fasttext`` backend)
+    :param bulk_mode: bulk action type (``index`` or ``update``)
+    :param bulk_options: keyword arguments for :class:`util.bulk_writer.BulkWriter`
+    :param skip_html: do not store text/html message parts
+    """
+    detector = get_language_detector(lang_detector, model_path=lang_model)
+    es = util.get_es_client()
+    writer = BulkWriter(es, name='WARC indexer, pid {}'.format(os.getpid()), **bulk_options)
+    for filename, size, mtime in warcs:
+        record_count = _index_warc(filename, index, counter, detector, writer, bulk_mode, skip_html)
+        if record_count is None:
+            continue
+
+        try:
+            path = _get_warc_path(filename)
+            util.es_retry(es.index, index=_get_manifest_index(index), doc_type='_doc', id=path, body={
+                'path': path,
+                'size': size,
+                'mtime': mtime,
+                'record_count': record_count,
+                'modified': int(time() * 1000)
+            })
+        except Exception as e:
+            logger.error(e)
+
+    writer.log_stats()
+
+
+def _index_warc(filename, index, counter, lang_detector, writer, bulk_mode, skip_html=False):
     """
     Index individual WARC file.
 
     :param filename: WARC file name
     :param index: Elasticsearch index
     :param counter: Spark counter
+    :param lang_detector: language detector
+    :param writer: Elasticsearch bulk writer
+    :param bulk_mode: bulk action type (``index`` or ``update``)
+    :param skip_html: do not store text/html message parts
+    :return: number of indexed records or None if indexing failed
     """
     try:
-        nlp = spacy.load('en_core_web_sm')
-        nlp.add_pipe(LanguageDetector(), name='language_detector', last=True)
-        helpers.bulk(util.get_es_client(), _generate_docs(index, filename, nlp, counter))
+        actions = _generate_docs(index, filename, lang_detector, counter, bulk_mode, skip_html)
+        return writer.write(actions)[0]
     except Exception as e:
         logger.error(e)
+        return None
 
 
-def _generate_docs(index, filename, nlp, counter):
+def _split_header(header_name, header_dict, split_regex=_comma_regex):
+    """
+    Split multi-value header and normalize whitespace.
+
+    :param header_name: lower-case header name
+    :param header_dict: dict of message headers
+    :param split_regex: compiled regex for splitting header values
+    :return: None, single header value or list of values
+    """
+    headers = [_whitespace_seq_regex.sub(' ', h).strip()
+               for h in split_regex.split(header_dict.get(header_name, '')) if h.strip()]
+    if not headers:
+        return None
+    return headers if len(headers) > 1 else headers[0]
+
+
+def _parse_message(body, skip_html=False):
+    """
+    Parse raw email message in a single pass over its MIME parts.
+
+    :param body: raw message bytes
+    :param skip_html: do not decode text/html parts
+    :return: tuple of plain text, HTML text (None if skipped) and dict of lower-case indexed headers
+    """
+    mail = email.message_from_bytes(body)
+
+    text_parts = []
+    html_parts = []
+    for part in mail.walk():
+        content_type = part.get_content_type()
+        if content_type == 'text/plain':
+            text_parts.append(util.decode_message_part(part))
+        elif content_type == 'text/html' and not skip_html:
+            html_parts.append(util.decode_message_part(part))
+
+    mail_text = '\n'.join(text_parts).strip()
+    mail_html = '\n'.join(html_parts).strip() if not skip_html else None
+    mail_headers = {h: str(mail[h]) for h in INDEXED_HEADERS if h in mail}
+
+    return mail_text, mail_html, mail_headers
+
+
+def _generate_docs(index, filename, lang_detector, counter, bulk_mode='update', skip_html=False, lang_batch_size=100):
     """
     Generate Elasticsearch index docs.
 
     :param index: Elasticsearch index
     :param filename: WARC file name
-    :param nlp: SpaCy language model
+    :param lang_detector: language detector
     :param counter: Spark counter
+    :param bulk_mode: bulk action type (``index`` or ``update``)
+    :param skip_html: do not store text/html message parts
+    :param lang_batch_size: number of messages whose languages are detected at once
     :return: Generator of index doc actions
     """
-    email_regex = re.compile(r'((?:[a-zA-Z0-9_\-./+]+)@(?:(?:\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
-                             r'(?:(?:[a-zA-Z0-9\-]+\.)+))(?:[a-zA-Z]{2,}|[0-9]{1,3})(?:\]?))')
+    def make_action(doc):
+        if bulk_mode == 'index':
+            return {
+                "_index": index,
+                "_type": "message",
+                "_id": doc["warc_id"],
+                "_op_type": "index",
+                "_source": doc
+            }
+
+        # Keep language of existing documents, but set it for new ones and for those without a language
+        return {
+            "_index": index,
+            "_type": "message",
+            "_id": doc["warc_id"],
+            "_op_type": "update",
+            "script": {
+                "source": _UPDATE_SCRIPT,
+                "lang": "painless",
+                "params": {"doc": doc}
+            },
+            "upsert": doc
+        }
 
-    def split_header(header_name, header_dict, split_regex=','):
-        headers = [re.sub(r'\s+', ' ', h).strip()
-                   for h in re.split(split_regex, header_dict.get(header_name, '')) if h.strip()]
-        if not headers:
-            return None
-        return headers if len(headers) > 1 else headers[0]
+    # Docs waiting for language detection
+    pending = []
+
+    def detect_languages():
+        try:
+            langs = lang_detector.detect_batch([d['text_plain'] for d in pending])
+        except Exception as e:
+            logger.error(e)
+            langs = [None] * len(pending)
+
+        for d, l in zip(pending, langs):
+            d['lang'] = l if l is not None else 'UNKNOWN'
+            yield make_action(d)
+        pending.clear()
 
     with open(filename, 'rb') as f:
         iterator = ArchiveIterator(f)
         for record in iterator:
             warc_headers = record.rec_headers
-            body = record.content_stream().read()
-            mail = email.message_from_bytes(body)
             doc_id = warc_headers.get_header('WARC-Record-ID')
+            mail_text, mail_html, mail_headers = _parse_message(record.content_stream().read(), skip_html)
 
-            mail_text = '\n'.join(util.decode_message_part(p) for p in mail.walk()
-                                  if p.get_content_type() == 'text/plain').strip()
-            mail_html = '\n'.join(util.decode_message_part(p) for p in mail.walk()
-                                  if p.get_content_type() == 'text/html').strip()
-
-            mail_headers = {h.lower(): str(mail[h]) for h in mail}
             from_header = mail_headers.get('from', '')
-            from_email = re.search(email_regex, from_header)
+            from_email = _email_regex.search(from_header)
 
             try:
                 d = email.utils.parsedate_to_datetime(mail_headers.get('date'))
@@ -151,57 +377,40 @@ def _generate_docs(index, filename, nlp, counter):
             except TypeError:
                 mail_date = None
 
-            try:
-                lang = nlp(mail_text[:nlp.max_length])._.language['language']
-            except Exception as e:
-                lang = 'UNKNOWN'
-                logger.error(e)
-
             counter.add(1)
 
-            yield {
-                "_index": index,
-                "_type": "message",
-                "_id": doc_id,
-                "_op_type": "update",
-                "scripted_upsert": True,
-                "script": {
-                    "source": """
-                        if (ctx._source.containsKey("lang")) {
-                            params.doc.remove("lang");
-                        }
-                        ctx._source.putAll(params.doc);
-                    """,
-                    "params": {
-                        "doc": {
-                            "modified": int(time() * 1000),
-                            "id_hash": hash(doc_id),
-                            "group": os.path.basename(os.path.dirname(filename)),
-                            "warc_file": os.path.join(os.path.basename(os.path.dirname(filename)),
-                                                      os.path.basename(filename)),
-                            "warc_offset": iterator.offset,
-                            "warc_id": doc_id,
-                            "news_url": warc_headers.get_header("WARC-News-URL"),
-                            "headers": {
-                                "date": mail_date,
-                                "message_id": mail_headers.get("message-id"),
-                                "from": from_header,
-                                "from_email": from_email.group(0) if from_email is not None else "",
-                                "subject": mail_headers.get("subject"),
-                                "to": split_header("to", mail_headers),
-                                "cc": split_header("cc", mail_headers),
-                                "in_reply_to": split_header("in-reply-to", mail_headers),
-                                "references": split_header("references", mail_headers, split_regex=r"\s"),
-                                "list_id": mail_headers.get("list-id")
-                            },
-                            "lang": lang,
-                            "text_plain": mail_text,
-                            "text_html": mail_html
-                        }
-                    }
+            doc = {
+                "modified": int(time() * 1000),
+                "id_hash": util.stable_hash(doc_id),
+                "group": os.path.basename(os.path.dirname(filename)),
+                "warc_file": _get_warc_path(filename),
+                "warc_offset": iterator.offset,
+                "warc_id": doc_id,
+                "news_url": warc_headers.get_header("WARC-News-URL"),
+                "headers": {
+                    "date": mail_date,
+                    "message_id": mail_headers.get("message-id"),
+                    "from": from_header,
+                    "from_email": from_email.group(0) if from_email is not None else "",
+                    "subject": mail_headers.get("subject"),
+                    "to": _split_header("to", mail_headers),
+                    "cc": _split_header("cc", mail_headers),
+                    "in_reply_to": _split_header("in-reply-to", mail_headers),
+                    "references": _split_header("references", mail_headers, split_regex=_whitespace_regex),
+                    "list_id": mail_headers.get("list-id")
                 },
-                "upsert": {}
+                "lang": None,
+                "text_plain": mail_text
             }
+            if not skip_html:
+                doc["text_html"] = mail_html
+
+            pending.append(doc)
+
+            if len(pending) >= lang_batch_size:
+                yield from detect_languages()
+
+    yield from detect_languages()
 
 
 if __name__ == '__main__':
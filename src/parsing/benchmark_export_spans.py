@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import random
+from time import perf_counter
+
+import click
+import numpy as np
+
+from parsing.message_segmenter import CONTEXT_SHAPE, export_mail_annotation_spans
+from util.mail_classification import load_fasttext_model, MailLinesSequence
+
+
+def _generate_message(num_lines, rand):
+    """
+    Generate a synthetic message consisting of blocks of lines with the same label.
+
+    :param num_lines: number of message lines
+    :param rand: random number generator
+    :return: message text and label IDs of all lines
+    """
+    templates = {
+        'paragraph': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit {}.',
+        'quotation': '> On Monday, someone wrote about issue #{}:',
+        'log_data': '2020-01-01 12:00:{:02d} [main] INFO  Connection established',
+        'patch': '+    return value + {}',
+        'personal_signature': '-- Jane Doe, Example Inc. ({})',
+        '<empty>': ''
+    }
+    labels = list(templates)
+
+    lines = []
+    label_ids = []
+    while len(lines) < num_lines:
+        label = rand.choice(labels)
+        for i in range(min(rand.randint(1, 30), num_lines - len(lines))):
+            lines.append(templates[label].format(i % 60))
+            label_ids.append(MailLinesSequence.LABEL_MAP[label])
+
+    return '\n'.join(lines), label_ids
+
+
+@click.command()
+@click.argument('fasttext-model', type=click.Path(exists=True, dir_okay=False))
+@click.option('-n', '--num-lines', help='Message sizes in lines', type=int, multiple=True,
+              default=[1000, 2000, 4000, 8000, 16000, 32000])
+@click.option('-r', '--repeat', help='Number of timed runs per message size (best run is reported)', type=int,
+              default=3)
+def main(fasttext_model, num_lines, repeat):
+    """
+    Benchmark export_mail_annotation_spans on long synthetic messages.
+
+    Only the export is timed. With linear run time, the time per line stays
+    roughly constant as the message size grows.
+
+    Arguments:
+        fasttext_model: pre-trained FastText embedding
+    """
+    load_fasttext_model(fasttext_model)
+    rand = random.Random(0)
+
+    click.echo('{:>10}  {:>10}  {:>10}'.format('lines', 'seconds', 'us/line'))
+    for n in num_lines:
+        text, label_ids = _generate_message(n, rand)
+        one_hot = np.eye(len(MailLinesSequence.LABEL_MAP), dtype=np.float32)[label_ids]
+        pred_seq = MailLinesSequence([json.dumps({'id': 0, 'text': text})], CONTEXT_SHAPE, labeled=False)
+        metadata = dict(pred_seq.mail_metadata_map)
+
+        best = float('inf')
+        for _ in range(repeat):
+            # The exporter releases mail metadata and overwrites predictions in place
+            pred_seq.mail_metadata_map = dict(metadata)
+            predictions = one_hot.copy()
+
+            start = perf_counter()
+            export_mail_annotation_spans(predictions, pred_seq, io.StringIO(), verbose=False)
+            best = min(best, perf_counter() - start)
+
+        click.echo('{:>10}  {:>10.3f}  {:>10.1f}'.format(n, best, best / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
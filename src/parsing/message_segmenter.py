@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
-import gc
 import json
 import os
 import re
@@ -17,17 +16,11 @@ from tqdm import tqdm
 import numpy as np
 
 from util import util
-from util.mail_classification import load_fasttext_model, MailLinesSequence
+from util.mail_classification import get_embedding_store_path, load_fasttext_model, MailLinesSequence
 
 
 logger = util.get_logger(__name__)
 
-# Limit Tensorflow GPU memory
-config = ConfigProto()
-config.gpu_options.per_process_gpu_memory_fraction = 0.2
-config.gpu_options.allow_growth = True
-InteractiveSession(config=config)
-
 
 TRAIN_BATCH_SIZE = 128                      # Training mini-batch size
 INF_BATCH_SIZE = 256                        # Inference mini-batch size
@@ -37,11 +30,28 @@ CONTEXT_SHAPE = (9, LINE_LEN, INPUT_DIM)    # Shape of the model context matrix
 
 tf.get_logger().setLevel('ERROR')
 
+_tf_session = None
+
+
+def init_tf_session():
+    """
+    Create the global TensorFlow session with limited GPU memory (only once).
+
+    The session is not created at import time, so that worker processes can still be forked
+    safely (e.g., by a :class:`util.mail_classification.LineEmbeddingPool`) after importing this module.
+    """
+    global _tf_session
+    if _tf_session is None:
+        config = ConfigProto()
+        config.gpu_options.per_process_gpu_memory_fraction = 0.2
+        config.gpu_options.allow_growth = True
+        _tf_session = InteractiveSession(config=config)
+
 
 @click.group()
 def main():
     """Train, apply, or evaluate an email or newsgroup message segmentation model."""
-    pass
+    init_tf_session()
 
 
 @main.command()
@@ -54,6 +64,8 @@ def main():
 @click.option('-f', '--fine-tune', help='Only fine-tune the given pre-trained model',
               type=click.Path(exists=True, dir_okay=False))
 @click.option('-t', '--tensorboard', is_flag=True, help='Tensorboard log data directory')
+@click.option('-e', '--embedding-store', help='Directory with precomputed embeddings (see precompute-embeddings)',
+              type=click.Path(exists=True, file_okay=False))
 def train(fasttext_model, train_data, output, **kwargs):
     """
     Train message segmenter to classify lines of an email or newsgroup message.
@@ -63,9 +75,39 @@ def train(fasttext_model, train_data, output, **kwargs):
         train_data: input training data as JSON
         output: Model output
     """
+    train_model(train_data, output, fasttext_model=fasttext_model, **kwargs)
+
+
+@main.command('precompute-embeddings')
+@click.argument('fasttext-model', type=click.Path(exists=True, dir_okay=False))
+@click.argument('input-data', type=click.Path(exists=True, dir_okay=False))
+@click.argument('store-dir', type=click.Path(file_okay=False))
+def precompute_embeddings(fasttext_model, input_data, store_dir):
+    """
+    Precompute padded line embeddings of labeled training or evaluation data.
+
+    The embeddings are memory-mapped by the train and evaluate commands when
+    started with the same --embedding-store, so fastText is skipped entirely.
+
+    Arguments:
+        fasttext_model: pre-trained FastText embedding
+        input_data: labeled input data as JSON
+        store_dir: embedding store base directory
+    """
+    store_path = get_embedding_store_path(store_dir, fasttext_model, input_data, CONTEXT_SHAPE[1:])
+    if os.path.isdir(store_path):
+        logger.info('Embeddings already precomputed in {}'.format(store_path))
+        return
+
     logger.info('Loading FastText model')
     load_fasttext_model(fasttext_model)
-    train_model(train_data, output, **kwargs)
+
+    logger.info('Embedding {}'.format(input_data))
+    seq = MailLinesSequence(input_data, CONTEXT_SHAPE, labeled=True)
+
+    os.makedirs(store_dir, exist_ok=True)
+    seq.save_embeddings(store_path)
+    logger.info('Saved embeddings of {} lines to {}'.format(seq.num_lines, store_path))
 
 
 @main.command()
@@ -73,6 +115,8 @@ def train(fasttext_model, train_data, output, **kwargs):
 @click.argument('fasttext-model', type=click.Path(exists=True, dir_okay=False))
 @click.argument('test-data', type=click.File('r'))
 @click.option('-o', '--output-json', help='Output JSONL file', type=click.File('w'))
+@click.option('-c', '--chunk-size', help='Predict mails with more lines in overlapping windows of this size',
+              type=int, default=3000)
 def predict(model, fasttext_model, test_data, **kwargs):
     """
     Apply trained message segmentation model to predict lines of an email or newsgroup message.
@@ -91,18 +135,18 @@ def predict(model, fasttext_model, test_data, **kwargs):
     to_stdout = output_json is None
 
     logger.info('Predicting {}'.format(test_data.name))
-    while True:
-        # Do not load more than 1k lines at once
-        pred_seq = MailLinesSequence(test_data, CONTEXT_SHAPE, labeled=False, batch_size=INF_BATCH_SIZE, max_lines=1000)
-        if len(pred_seq) == 0:
-            break
 
-        predictions = segmenter.predict(pred_seq,
-                                        verbose=(not to_stdout),
-                                        steps=(None if not to_stdout else 10),
-                                        use_multiprocessing=True,
-                                        workers=pred_seq.num_workers,
-                                        max_queue_size=pred_seq.max_queue_size)
+    # Do not load more than 1k mails at once
+    for pred_seq in _iter_prediction_sequences(test_data, kwargs['chunk_size'], max_mails=1000):
+        if type(pred_seq) is _WindowedMail:
+            predictions = pred_seq.predict(segmenter)
+        else:
+            predictions = segmenter.predict(pred_seq,
+                                            verbose=(not to_stdout),
+                                            steps=(None if not to_stdout else 10),
+                                            use_multiprocessing=True,
+                                            workers=pred_seq.num_workers,
+                                            max_queue_size=pred_seq.max_queue_size)
         export_mail_annotation_spans(predictions, pred_seq, output_json, verbose=to_stdout)
 
         if output_json:
@@ -115,8 +159,10 @@ def predict(model, fasttext_model, test_data, **kwargs):
 @main.command()
 @click.argument('model', type=click.Path(exists=True, dir_okay=False))
 @click.argument('fasttext-model', type=click.Path(exists=True, dir_okay=False))
-@click.argument('eval-data', type=click.File('r'))
-def evaluate(model, fasttext_model, eval_data):
+@click.argument('eval-data', type=click.Path(exists=True, dir_okay=False))
+@click.option('-e', '--embedding-store', help='Directory with precomputed embeddings (see precompute-embeddings)',
+              type=click.Path(exists=True, file_okay=False))
+def evaluate(model, fasttext_model, eval_data, embedding_store):
     """
     Evaluate a trained message segmentation model.
 
@@ -125,9 +171,6 @@ def evaluate(model, fasttext_model, eval_data):
         fasttext_model: pre-trained FastText embedding
         eval_data: test message dump as JSON
     """
-    logger.info('Loading FastText model')
-    load_fasttext_model(fasttext_model)
-
     def _binarize_pred_tensors(cls, *tensors):
         """Binarize multi-class prediction tensors to the given class."""
         cls = MailLinesSequence.LABEL_MAP[cls] if type(cls) is str else cls
@@ -156,8 +199,8 @@ def evaluate(model, fasttext_model, eval_data):
     segmenter = models.load_model(model)
     segmenter.compile(optimizer=segmenter.optimizer, loss=segmenter.loss, metrics=eval_metrics)
 
-    logger.info('Evaluating \'{}\''.format(eval_data.name))
-    eval_seq = MailLinesSequence(eval_data, CONTEXT_SHAPE, labeled=True, batch_size=INF_BATCH_SIZE)
+    logger.info('Evaluating \'{}\''.format(eval_data))
+    eval_seq = _load_labeled_sequence(eval_data, fasttext_model, INF_BATCH_SIZE, embedding_store)
 
     cls_sum = np.zeros(len(MailLinesSequence.LABEL_MAP))
     y_true = np.zeros(0)
@@ -166,7 +209,7 @@ def evaluate(model, fasttext_model, eval_data):
         y_true = np.concatenate((y_true,  np.argmax(labels, axis=1)))
 
     click.echo('Ground-truth class distribution:')
-    cls_sum /= len(eval_seq) * INF_BATCH_SIZE
+    cls_sum /= len(y_true)
     cls_sum = sorted(enumerate(cls_sum), key=lambda x: x[1], reverse=True)
     for i, prob in cls_sum:
         click.echo(' {: >19}: {:.4f}'.format(MailLinesSequence.LABEL_MAP_INVERSE[i], prob))
@@ -196,17 +239,42 @@ def evaluate(model, fasttext_model, eval_data):
     click.echo([l for l in MailLinesSequence.LABEL_MAP.keys()])
 
 
-def train_model(training_data, output_model, loss_function='categorical_crossentropy',
-                validation_data=None, fine_tune=None, tensorboard=False):
+def _load_labeled_sequence(input_data, fasttext_model, batch_size, embedding_store=None):
+    """
+    Load labeled input data, preferably from precomputed embeddings.
+
+    :param input_data: path to JSON file with labeled data
+    :param fasttext_model: path to fastText model
+    :param batch_size: mini-batch size
+    :param embedding_store: embedding store base directory
+    :return: MailLinesSequence
+    """
+    if embedding_store:
+        store_path = get_embedding_store_path(embedding_store, fasttext_model, input_data, CONTEXT_SHAPE[1:])
+        if os.path.isdir(store_path):
+            logger.info('Loading precomputed embeddings from {}'.format(store_path))
+            return MailLinesSequence(store_path, CONTEXT_SHAPE, labeled=True, batch_size=batch_size,
+                                     input_is_embedding_store=True)
+        logger.warning('No precomputed embeddings for {} found, falling back to FastText.'.format(input_data))
+
+    logger.info('Loading FastText model')
+    load_fasttext_model(fasttext_model)
+    return MailLinesSequence(input_data, CONTEXT_SHAPE, labeled=True, batch_size=batch_size)
+
+
+def train_model(training_data, output_model, fasttext_model, loss_function='categorical_crossentropy',
+                validation_data=None, fine_tune=None, tensorboard=False, embedding_store=None):
     """
     Train message segmentation model.
 
     :param training_data: JSON file with training data
     :param output_model: path prefix for model checkpoints
+    :param fasttext_model: path to fastText model
     :param loss_function: optimization loss function
     :param validation_data: JSON file with validation data
     :param fine_tune: fine-tune model from given file instead of training from scratch
     :param tensorboard: Tensorboard log data directory
+    :param embedding_store: directory with precomputed embeddings
     """
 
     tb_callback = callbacks.TensorBoard(log_dir='./data/graph/' + str(datetime.now()), update_freq='batch',
@@ -270,9 +338,9 @@ def train_model(training_data, output_model, loss_function='categorical_crossent
     segmenter.compile(**compile_args)
     segmenter.summary()
 
-    train_seq = MailLinesSequence(training_data, CONTEXT_SHAPE, labeled=True, batch_size=TRAIN_BATCH_SIZE)
-    val_seq = MailLinesSequence(validation_data, CONTEXT_SHAPE, labeled=True,
-                                batch_size=INF_BATCH_SIZE) if validation_data else None
+    train_seq = _load_labeled_sequence(training_data, fasttext_model, TRAIN_BATCH_SIZE, embedding_store)
+    val_seq = _load_labeled_sequence(validation_data, fasttext_model, INF_BATCH_SIZE,
+                                     embedding_store) if validation_data else None
 
     epochs = 20 if fine_tune is None else 10
     segmenter.fit_generator(train_seq, epochs=epochs, validation_data=val_seq, shuffle=True, use_multiprocessing=False,
@@ -291,40 +359,255 @@ def train_model(training_data, output_model, loss_function='categorical_crossent
     #                             callbacks=effective_callbacks)
 
 
+class MessageSegmenter:
+    """
+    Long-lived inference session for a trained segmentation model.
+
+    The model is loaded only once and its forward pass is compiled into a graph function with a fixed
+    input signature, so repeated predictions neither retrace the graph nor require clearing the Keras session.
+    Instances can be used in place of a Keras model in :func:`predict_raw_text` and :func:`predict_batch`.
+    """
+
+    def __init__(self, model):
+        """
+        :param model: trained HDF5 segmenter model (path or loaded Keras model)
+        """
+        init_tf_session()
+        self.model = models.load_model(model) if type(model) is str else model
+
+        line_spec = tf.TensorSpec((None,) + CONTEXT_SHAPE[1:], tf.float32)
+        context_spec = tf.TensorSpec((None,) + CONTEXT_SHAPE, tf.float32)
+        self._predict_fn = tf.function(self._forward, input_signature=(line_spec, line_spec, context_spec))
+
+    def _forward(self, line, line_prev, context):
+        return self.model([line, line_prev, context], training=False)
+
+    def predict(self, pred_seq):
+        """
+        Predict labels of all lines in a sequence.
+
+        :param pred_seq: unlabeled MailLinesSequence
+        :return: predicted labels as softmax vectors
+        """
+        if len(pred_seq) == 0:
+            return np.empty((0, len(MailLinesSequence.LABEL_MAP)), dtype=np.float32)
+
+        return np.concatenate([self._predict_fn(*pred_seq[i]).numpy() for i in range(len(pred_seq))])
+
+
 def predict_raw_text(segmentation_model, message, chunk_size=3000):
     """
     Predict segments of raw message text.
 
-    :param segmentation_model: Trained segmentation model
+    :param segmentation_model: Trained segmentation model or :class:`MessageSegmenter`
     :param message: email message text
     :param chunk_size: size of chunks to split larger messages into for segmentation
     :return: Generator of (message text, label text)
     """
 
-    # Split long emails into chunks (sacrifice context at chunk boundaries to keep things simple)
+    for chunk, head, num_lines in _split_message_chunks(message, chunk_size):
+        pred_seq = MailLinesSequence(chunk, CONTEXT_SHAPE, labeled=False, input_is_raw_text=True,
+                                     batch_size=INF_BATCH_SIZE)
+        yield from list(_post_process_labels(pred_seq, segmentation_model.predict(pred_seq)))[head:head + num_lines]
+
+
+def predict_batch(segmentation_model, messages, chunk_size=3000, max_lines=INF_BATCH_SIZE * 64, embedding_pool=None):
+    """
+    Predict segments of many raw message texts at once.
+
+    Lines of all messages are packed into shared inference batches, but context windows
+    and label post-processing never cross message boundaries, so the predictions for each
+    message are the same as those of :func:`predict_raw_text`.
+
+    :param segmentation_model: Trained segmentation model or :class:`MessageSegmenter`
+    :param messages: list of email message texts
+    :param chunk_size: size of chunks to split larger messages into for segmentation
+    :param max_lines: maximum number of lines of packed messages predicted at once (bounds memory usage)
+    :param embedding_pool: :class:`util.mail_classification.LineEmbeddingPool` for embedding the lines
+                           of the next packed messages while the current ones are predicted (optional)
+    :return: list of lists of (message text, label text), one for each input message
+    """
+    predictions = [[] for _ in messages]
+    groups = list(_pack_message_chunks(messages, chunk_size, max_lines))
+
+    if embedding_pool is None:
+        for chunks in groups:
+            _predict_chunks(segmentation_model, chunks, predictions)
+        return predictions
+
+    pending = embedding_pool.embed_lines_async(_get_chunk_lines(groups[0])) if groups else None
+    for i, chunks in enumerate(groups):
+        line_embeddings = pending()
+        if i + 1 < len(groups):
+            pending = embedding_pool.embed_lines_async(_get_chunk_lines(groups[i + 1]))
+        _predict_chunks(segmentation_model, chunks, predictions, line_embeddings)
+
+    return predictions
+
+
+def _pack_message_chunks(messages, chunk_size, max_lines):
+    """
+    Split messages into chunks and pack them into groups of at most `max_lines` lines.
+    A chunk window longer than `max_lines` forms a group of its own.
+
+    :param messages: list of email message texts
+    :param chunk_size: size of chunks to split larger messages into for segmentation
+    :param max_lines: maximum number of lines per group
+    :return: Generator of lists of (message index, chunk text, number of leading context lines, number of lines)
+    """
+    chunks = []
+    num_lines = 0
+    for i, message in enumerate(messages):
+        for chunk, head, chunk_lines in _split_message_chunks(message, chunk_size):
+            window_lines = chunk.count('\n') + 1
+            if chunks and num_lines + window_lines > max_lines:
+                yield chunks
+                chunks = []
+                num_lines = 0
+
+            chunks.append((i, chunk, head, chunk_lines))
+            num_lines += window_lines
+
+    if chunks:
+        yield chunks
+
+
+def _get_chunk_lines(chunks):
+    """
+    :param chunks: list of (message index, chunk text, number of leading context lines, number of lines)
+    :return: lines of all chunks as they are loaded by :class:`MailLinesSequence`
+    """
+    return [l + '\n' for _, chunk, _, _ in chunks for l in chunk.split('\n')]
+
+
+def _predict_chunks(segmentation_model, chunks, predictions, line_embeddings=None):
+    """
+    Predict a list of message chunks in one sequence.
+
+    :param segmentation_model: Trained segmentation model or :class:`MessageSegmenter`
+    :param chunks: list of (message index, chunk text, number of leading context lines, number of lines)
+    :param predictions: list of message predictions to which the chunk predictions are appended
+    :param line_embeddings: precomputed embeddings of the chunk lines (optional)
+    """
+    pred_seq = MailLinesSequence([chunk for _, chunk, _, _ in chunks], CONTEXT_SHAPE, labeled=False,
+                                 input_is_raw_text=True, batch_size=INF_BATCH_SIZE, line_embeddings=line_embeddings,
+                                 separate_mail_context=True)
+    labels_softmax = segmentation_model.predict(pred_seq)
+
+    # Every chunk is a separate mail in the sequence, of which only the lines without
+    # the overlapping context are kept
+    offsets = sorted(pred_seq.mail_start_indices) + [pred_seq.num_lines]
+    for (owner, _, head, num_lines), start, end in zip(chunks, offsets[:-1], offsets[1:]):
+        predictions[owner].extend(list(_post_process_line_labels(
+            pred_seq.mail_lines[start:end], labels_softmax[start:end], {0}, {end - start}))[head:head + num_lines])
+
+
+def _split_message_chunks(message, chunk_size, overlap=CONTEXT_SHAPE[0] * 2):
+    """
+    Split long messages into sliding windows of lines.
+
+    Each window consists of a chunk of lines plus up to `overlap` lines of context from the
+    neighbouring chunks on each side, so that lines at chunk boundaries are predicted and
+    post-processed with the same context as the other lines. Only the predictions of the chunk
+    lines are to be kept, so that the concatenated chunks cover each message line exactly once.
+    Memory usage per window is bounded by `chunk_size`, regardless of the message length.
+
+    :param message: email message text
+    :param chunk_size: maximum number of lines per chunk
+    :param overlap: number of context lines on each side of a chunk
+    :return: Generator of (window text, number of leading context lines, number of chunk lines)
+    """
     message = message.split('\n')
 
-    finished = False
     for i in range(0, len(message), chunk_size):
         end = min(i + chunk_size, len(message))
         if len(message) - end < CONTEXT_SHAPE[0] * 2:
             end = len(message)
-            finished = True
-
-        chunk = message[i:end]
-        pred_seq = MailLinesSequence('\n'.join(chunk), CONTEXT_SHAPE, labeled=False, input_is_raw_text=True,
-                                     batch_size=INF_BATCH_SIZE)
-        yield from _post_process_labels(pred_seq, segmentation_model.predict(pred_seq))
 
-        del pred_seq
-        gc.collect()
+        start = max(0, i - overlap)
+        yield '\n'.join(message[start:min(end + overlap, len(message))]), i - start, end - i
 
-        if finished:
+        if end == len(message):
             break
 
-    del message
-    gc.collect()
-    K.clear_session()
+
+def _iter_prediction_sequences(json_file, chunk_size, max_mails=1000):
+    """
+    Lazily read unlabeled mails from a JSONL file in input order.
+
+    Mails with at most `chunk_size` lines are read as consecutive MailLinesSequences of at most `max_mails`
+    mails each. Longer mails are returned on their own as :class:`_WindowedMail`, so that only one window
+    of their lines is embedded at a time. Memory usage is therefore bounded regardless of the input size.
+
+    :param json_file: input JSONL file handle
+    :param chunk_size: maximum number of lines of mails which are not predicted in windows
+    :param max_mails: maximum number of mails per sequence
+    :return: Generator of MailLinesSequences and :class:`_WindowedMail` instances
+    """
+    def make_sequence(mails):
+        return MailLinesSequence(mails, CONTEXT_SHAPE, labeled=False, batch_size=INF_BATCH_SIZE)
+
+    mails = []
+    for json_text in json_file:
+        mail_json = json.loads(json_text)
+        if mail_json['text'].count('\n') < chunk_size:
+            mails.append(json_text)
+            if len(mails) >= max_mails:
+                yield make_sequence(mails)
+                mails = []
+            continue
+
+        if mails:
+            yield make_sequence(mails)
+            mails = []
+        yield _WindowedMail(mail_json, chunk_size)
+
+    if mails:
+        yield make_sequence(mails)
+
+
+class _WindowedMail:
+    """
+    Single long unlabeled mail which is predicted in overlapping windows (see :func:`_split_message_chunks`).
+
+    Instances provide the same mail attributes as a single-mail MailLinesSequence, so their predictions
+    can be exported with :func:`export_mail_annotation_spans`.
+    """
+
+    labeled = False
+
+    def __init__(self, mail_json, chunk_size):
+        """
+        :param mail_json: mail JSON dict with a "text" field
+        :param chunk_size: number of lines per window (without overlap)
+        """
+        self.text = mail_json['text']
+        self.chunk_size = chunk_size
+        self.mail_lines = [l + '\n' for l in self.text.split('\n')]
+        self.mail_start_indices = {0}
+        self.mail_end_indices = {len(self.mail_lines)}
+        self.mail_metadata_map = {0: mail_json}
+
+    @property
+    def num_lines(self):
+        return len(self.mail_lines)
+
+    def predict(self, segmentation_model):
+        """
+        Predict the label probabilities of all mail lines window by window.
+
+        Windows overlap by more than the model context, so the predictions are the same as
+        for the whole mail at once.
+
+        :param segmentation_model: Trained segmentation model or :class:`MessageSegmenter`
+        :return: predicted labels as softmax vectors
+        """
+        predictions = []
+        for window, head, num_lines in _split_message_chunks(self.text, self.chunk_size):
+            pred_seq = MailLinesSequence(window, CONTEXT_SHAPE, labeled=False, input_is_raw_text=True,
+                                         batch_size=INF_BATCH_SIZE)
+            predictions.append(segmentation_model.predict(pred_seq)[head:head + num_lines])
+        return np.concatenate(predictions)
 
 
 def reformat_raw_text_recursive(segmentation_model, email, exclude_classes=None, max_depth=10):
@@ -433,36 +716,64 @@ def _post_process_labels(mails_sequence, labels_softmax):
     """
 
     lines = mails_sequence.mail_lines
-    context_size = CONTEXT_SHAPE[0] // 2
+    if mails_sequence.labeled:
+        lines = [line[0] for line in lines]
+
+    yield from _post_process_line_labels(lines, labels_softmax, mails_sequence.mail_start_indices,
+                                         mails_sequence.mail_end_indices)
 
-    for i, (line, label) in enumerate(zip(lines, labels_softmax)):
-        line = line if not mails_sequence.labeled else line[0]
-        label_argmax = np.argmax(label)
-        label_argsort = np.argsort(label)[::-1]
-        label_text = MailLinesSequence.LABEL_MAP_INVERSE[label_argmax]
-
-        prev_l = []
-        for j in range(context_size):
-            if i - j < 0 or i - j + 1 in mails_sequence.mail_start_indices:
-                break
-            prev_l.append(MailLinesSequence.LABEL_MAP_INVERSE[np.argmax(labels_softmax[i - j])])
-        prev_l.extend([None] * (context_size - len(prev_l)))
-        prev_l.reverse()
-
-        next_l = []
-        for j in range(context_size):
-            if i + 1 + j >= len(lines) or i + 1 + j in mails_sequence.mail_end_indices:
-                break
-            next_l.append(MailLinesSequence.LABEL_MAP_INVERSE[np.argmax(labels_softmax[i + 1 + j])])
-        next_l.extend([None] * (context_size - len(next_l)))
+
+def _post_process_line_labels(lines, labels_softmax, mail_start_indices, mail_end_indices):
+    """
+    Postprocess predicted labels of a list of lines.
+
+    :param lines: line texts
+    :param labels_softmax: predicted labels as softmax vectors for `lines`
+    :param mail_start_indices: indices of lines starting a new mail
+    :param mail_end_indices: indices of lines after the last line of a mail
+    :return: Generator of (line text, label text)
+    """
+    context_size = CONTEXT_SHAPE[0] // 2
+    num_lines = min(len(lines), len(labels_softmax))
+    label_names = [MailLinesSequence.LABEL_MAP_INVERSE[i] for i in range(len(MailLinesSequence.LABEL_MAP))]
+
+    # Raw argmax and top-3 labels of all lines at once
+    labels_argmax = np.argmax(labels_softmax[:num_lines], axis=1)
+    labels_top3 = np.argsort(labels_softmax[:num_lines], axis=1)[:, :-4:-1].tolist()
+
+    # Number of context lines on each side that belong to the same mail. The previous
+    # context of a line includes the line itself.
+    line_indices = np.arange(num_lines)[:, np.newaxis]
+    prev_indices = line_indices - np.arange(context_size)
+    prev_outside = (prev_indices < 0) | np.isin(prev_indices + 1, list(mail_start_indices))
+    num_prev = np.sum(~np.logical_or.accumulate(prev_outside, axis=1), axis=1).tolist()
+    next_indices = line_indices + 1 + np.arange(context_size)
+    next_outside = (next_indices >= num_lines) | np.isin(next_indices, list(mail_end_indices))
+    num_next = np.sum(~np.logical_or.accumulate(next_outside, axis=1), axis=1).tolist()
+
+    # Label IDs of all lines, which are replaced with post-processed labels line by line,
+    # so that the previous context always consists of already post-processed labels
+    label_ids = labels_argmax.tolist()
+    pad_lines = []
+
+    for i in range(num_lines):
+        line = lines[i]
+        label_argsort = labels_top3[i]
+        label_text = label_names[label_ids[i]]
+
+        prev_l = [None] * (context_size - num_prev[i]) + \
+                 [label_names[l] for l in label_ids[i - num_prev[i] + 1:i + 1]]
+        next_l = [label_names[l] for l in label_ids[i + 1:i + 1 + num_next[i]]] + \
+                 [None] * (context_size - num_next[i])
 
         empty_classes = ['<empty>', 'visual_separator', None]
         prev_set_no_blank = set([l for l in prev_l if l not in empty_classes])
         next_set_no_blank = set([l for l in next_l if l not in empty_classes])
 
-        if line is None or label is None:
+        if line is None:
             yield '<PAD>\n', None
-            labels_softmax[i] = -1
+            label_ids[i] = 0
+            pad_lines.append(i)
             continue
 
         # Correct <empty>
@@ -492,7 +803,7 @@ def _post_process_labels(mails_sequence, labels_softmax):
 
         # Quotation markers
         elif label_text == 'quotation' and prev_l[-1] in empty_classes \
-                and mails_sequence.LABEL_MAP['quotation_marker'] in label_argsort[:3]:
+                and MailLinesSequence.LABEL_MAP['quotation_marker'] in label_argsort[:3]:
             label_text = 'quotation_marker'
 
         # Interrupted short blocks
@@ -505,7 +816,7 @@ def _post_process_labels(mails_sequence, labels_softmax):
                 [*prev_set_no_blank][0] in next_set_no_blank \
                 and [*prev_set_no_blank][0] in ['mua_signature', 'personal_signature',
                                                 'patch', 'code', 'tabular', 'technical'] \
-                and mails_sequence.LABEL_MAP[[*prev_set_no_blank][0]] == label_argsort[1]:
+                and MailLinesSequence.LABEL_MAP[[*prev_set_no_blank][0]] == label_argsort[1]:
             label_text = [*prev_set_no_blank][0]
 
         # Interrupting stray classes
@@ -514,22 +825,27 @@ def _post_process_labels(mails_sequence, labels_softmax):
                 and (next_l[0] == prev_l[-1] or (next_l[1] == prev_l[-1] and next_l[0] in empty_classes)):
             label_text = prev_l[-1]
 
-        labels_softmax[i] = mails_sequence.LABEL_MAP_ONEHOT[label_text]
+        label_ids[i] = MailLinesSequence.LABEL_MAP[label_text]
         yield line, label_text
 
+    # Replace softmax vectors with post-processed labels
+    labels_softmax[:num_lines] = np.eye(len(MailLinesSequence.LABEL_MAP))[label_ids]
+    labels_softmax[pad_lines] = -1
+
 
 def export_mail_annotation_spans(predictions_softmax, pred_sequence, output_file=None, verbose=True):
     """
     Export predicted lines to JSON (start, end) spans.
 
     :param predictions_softmax: predicted labels as softmax vectors
-    :param pred_sequence: input line sequence
+    :param pred_sequence: input line sequence (mail metadata is released during export)
     :param output_file: output JSON file
     :param verbose: print labeled lines to STDOUT
     """
 
-    text = ''
-    main_content = ''
+    # Length of the mail text with leading whitespace stripped
+    text_len = 0
+    main_content = []
     annotations = []
     prev_label = None
     cur_label = None
@@ -558,26 +874,26 @@ def export_mail_annotation_spans(predictions_softmax, pred_sequence, output_file
         if i in pred_sequence.mail_start_indices:
             if verbose:
                 click.echo(' {0:>>20}    --->    <<< MAIL START >>>'.format(''))
-            mail_dict = pred_sequence.mail_metadata_map.get(i, {})
+            # Release metadata of mails as soon as they are exported
+            mail_dict = pred_sequence.mail_metadata_map.pop(i, {})
 
-        cur_offset = len(text) - 1
-        text += line
-        text = text.lstrip()
+        cur_offset = text_len - 1
+        text_len = text_len + len(line) if text_len > 0 else len(line.lstrip())
         if cur_label in ['paragraph', 'section_heading']:
-            main_content += line
+            main_content.append(line)
 
         if i in pred_sequence.mail_end_indices:
             if output_file:
                 if prev_label not in [None, '<empty>']:
                     annotations.append((start_offset, cur_offset, prev_label))
-                write_annotations(mail_dict, annotations, main_content)
+                write_annotations(mail_dict, annotations, ''.join(main_content))
 
             mail_dict = None
             annotations.clear()
             start_offset = 0
             prev_label = None
-            text = ''
-            main_content = ''
+            text_len = 0
+            main_content.clear()
             continue
 
         if verbose:
@@ -592,8 +908,8 @@ def export_mail_annotation_spans(predictions_softmax, pred_sequence, output_file
 
     if output_file and mail_dict:
         if cur_label not in ['<empty>', None]:
-            annotations.append((start_offset, len(text) - 1, cur_label))
-        write_annotations(mail_dict, annotations, main_content)
+            annotations.append((start_offset, text_len - 1, cur_label))
+        write_annotations(mail_dict, annotations, ''.join(main_content))
 
 
 if __name__ == '__main__':
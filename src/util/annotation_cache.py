@@ -0,0 +1,91 @@
+from hashlib import sha256
+import json
+import os
+import sqlite3
+import threading
+
+
+class AnnotationCache:
+    """
+    On-disk SQLite cache of message annotations, keyed by a content hash of the message text
+    and the annotation version, so that identical messages (e.g., cross-posts) are annotated only once.
+    The cache file can be shared by several processes on the same host.
+    """
+
+    def __init__(self, path, version):
+        """
+        :param path: SQLite database file
+        :param version: annotation version (cached annotations of other versions are ignored)
+        """
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS annotations ('
+                               'hash TEXT NOT NULL, version INTEGER NOT NULL, data TEXT NOT NULL, '
+                               'PRIMARY KEY (hash, version))')
+
+    @staticmethod
+    def get_text_hash(text):
+        """
+        :param text: message text
+        :return: hex SHA-256 digest of the text
+        """
+        return sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def get_many(self, text_hashes):
+        """
+        Look up cached annotations.
+
+        :param text_hashes: list of text hashes
+        :return: dict of text hashes to cached annotation dicts (missing hashes are omitted)
+        """
+        if not text_hashes:
+            return {}
+
+        results = {}
+        with self._lock:
+            # Stay below SQLite's default limit of bound query parameters
+            for i in range(0, len(text_hashes), 500):
+                part = text_hashes[i:i + 500]
+                rows = self._conn.execute(
+                    'SELECT hash, data FROM annotations WHERE version = ? AND hash IN ({})'.format(
+                        ','.join('?' * len(part))), [self.version] + part)
+                results.update((h, json.loads(d)) for h, d in rows)
+
+            self.hits += len(results)
+            self.misses += len(text_hashes) - len(results)
+        return results
+
+    def put_many(self, annotations):
+        """
+        Store annotations in the cache.
+
+        :param annotations: dict of text hashes to JSON-serializable annotation dicts
+        """
+        if not annotations:
+            return
+
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO annotations (hash, version, data) VALUES (?, ?, ?)',
+                                   [(h, self.version, json.dumps(a)) for h, a in annotations.items()])
+
+    @property
+    def hit_rate(self):
+        """Ratio of cache hits to total lookups."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        """
+        Close database connection.
+        """
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,188 @@
+from base64 import b64encode
+from bisect import bisect_right
+from hashlib import sha256
+import re
+
+from util import util
+
+logger = util.get_logger(__name__)
+
+
+class EmailAnonymizer:
+    """
+    Replace email addresses in message texts and headers with stable pseudonyms.
+
+    Pseudonyms are memoized in a bounded LRU cache, since the same addresses occur in a large
+    number of messages. Message text and header values are anonymized in a single regex pass.
+    """
+
+    EMAIL_REGEX = re.compile(r'((?:[a-zA-Z0-9_\-./+]+)@(?:(?:\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
+                             r'(?:(?:[a-zA-Z0-9\-]+\.)+))(?:[a-zA-Z]{2,}|[0-9]{1,3})(?:\]?))')
+
+    # Headers kept in anonymized messages
+    KEPT_HEADERS = {'message_id', 'subject', 'from', 'to', 'cc', 'in_reply_to', 'references', 'list_id'}
+
+    # Headers of which only the email address is kept
+    ADDRESS_HEADERS = {'from', 'from_email', 'to', 'cc', 'in_reply_to'}
+
+    # Characters that can occur before and after the "@" of an email address match
+    _LOCAL_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-./+')
+    _DOMAIN_RUN_REGEX = re.compile(r'[a-zA-Z0-9\-.\[\]]*')
+
+    # Separator for joining texts into one string (cannot be part of an email address match)
+    _SEPARATOR = '\x00'
+
+    def __init__(self, memo_size=100000):
+        """
+        :param memo_size: maximum number of memoized address pseudonyms
+        """
+        self.memo = util.LRUCache(memo_size)
+
+    def pseudonymize(self, address):
+        """
+        :param address: email address
+        :return: pseudonymized email address
+        """
+        pseudonym = self.memo.get(address)
+        if pseudonym is None:
+            pseudonym = b64encode(sha256(address.encode()).digest())[:16].decode() + '@example.com'
+            self.memo.put(address, pseudonym)
+        return pseudonym
+
+    def _find_addresses(self, text):
+        """
+        Find all email addresses in a text.
+
+        Yields the same matches as ``EMAIL_REGEX.finditer(text)``, but the regex is only run on the
+        character runs around "@" signs, since trying to match at every position of long texts is slow.
+
+        :param text: input text
+        :return: generator of regex match objects
+        """
+        region_start = region_end = -1
+        at = text.find('@')
+        while at != -1:
+            start = at
+            while start > 0 and text[start - 1] in self._LOCAL_CHARS:
+                start -= 1
+            end = self._DOMAIN_RUN_REGEX.match(text, at + 1).end()
+
+            if start > region_end:
+                if region_end != -1:
+                    yield from self.EMAIL_REGEX.finditer(text, region_start, region_end)
+                region_start = start
+            region_end = end
+            at = text.find('@', end)
+
+        if region_end != -1:
+            yield from self.EMAIL_REGEX.finditer(text, region_start, region_end)
+
+    def _replace_addresses(self, text, on_match=None):
+        """
+        :param text: input text
+        :param on_match: function called with every match and its pseudonym (optional)
+        :return: text with all email addresses replaced
+        """
+        parts = []
+        last_end = 0
+        for m in self._find_addresses(text):
+            pseudonym = self.pseudonymize(m.group())
+            if on_match is not None:
+                on_match(m, pseudonym)
+            parts.append(text[last_end:m.start()])
+            parts.append(pseudonym)
+            last_end = m.end()
+
+        if not parts:
+            return text
+        parts.append(text[last_end:])
+        return ''.join(parts)
+
+    def anonymize_text(self, text):
+        """
+        :param text: input text
+        :return: text with all email addresses replaced
+        """
+        return self._replace_addresses(text)
+
+    def _anonymize_parts(self, parts):
+        """
+        Anonymize several texts in one regex pass.
+
+        :param parts: list of texts
+        :return: list of anonymized texts and list of pseudonyms of the first address in each text (or None)
+        """
+        first_pseudonyms = [None] * len(parts)
+
+        if any(self._SEPARATOR in p for p in parts):
+            anonymized = []
+            for i, p in enumerate(parts):
+                def set_first(_, pseudonym, i=i):
+                    if first_pseudonyms[i] is None:
+                        first_pseudonyms[i] = pseudonym
+                anonymized.append(self._replace_addresses(p, set_first))
+            return anonymized, first_pseudonyms
+
+        part_starts = []
+        offset = 0
+        for p in parts:
+            part_starts.append(offset)
+            offset += len(p) + 1
+
+        def set_first(m, pseudonym):
+            i = bisect_right(part_starts, m.start()) - 1
+            if first_pseudonyms[i] is None:
+                first_pseudonyms[i] = pseudonym
+
+        joined = self._replace_addresses(self._SEPARATOR.join(parts), set_first)
+        return joined.split(self._SEPARATOR), first_pseudonyms
+
+    def anonymize_message(self, text, headers):
+        """
+        Anonymize message text and headers.
+
+        Only headers in :attr:`KEPT_HEADERS` are kept. Of the headers in :attr:`ADDRESS_HEADERS`,
+        only the (anonymized) email address is kept. ``list_id`` is left as is.
+
+        :param text: message text
+        :param headers: dict of message headers
+        :return: anonymized text and headers
+        """
+        headers = {k: v for k, v in headers.items() if v and k in self.KEPT_HEADERS}
+        for h in ('to', 'cc'):
+            if h in headers and type(headers[h]) is not list:
+                headers[h] = [headers[h]]
+
+        # Collect all texts to anonymize as (header, list index) -> part index
+        parts = [text]
+        part_indices = {}
+        for h, v in headers.items():
+            if type(v) is list:
+                for i, x in enumerate(v):
+                    part_indices[(h, i)] = len(parts)
+                    parts.append(x)
+            elif h != 'list_id':
+                part_indices[(h, None)] = len(parts)
+                parts.append(v)
+
+        anonymized, first_pseudonyms = self._anonymize_parts(parts)
+
+        def get_value(h, i, extract_address):
+            p = part_indices[(h, i)]
+            if not extract_address:
+                return anonymized[p]
+            if first_pseudonyms[p] is None:
+                # Use value as is if not an email address
+                logger.warning('Expected email address in "{}", but couldn\'t find any.'.format(parts[p]))
+                return anonymized[p]
+            return first_pseudonyms[p]
+
+        for h, v in headers.items():
+            if type(v) is list:
+                if h in self.ADDRESS_HEADERS and h not in {'to', 'cc'}:
+                    logger.warning('Expected email address in "{}", but couldn\'t find any.'.format(v))
+                headers[h] = [get_value(h, i, h in {'to', 'cc'}) for i in range(len(v))]
+            elif h != 'list_id':
+                headers[h] = get_value(h, None, h in self.ADDRESS_HEADERS)
+
+        return anonymized[0], headers
@@ -0,0 +1,232 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import threading
+from time import monotonic, sleep
+
+from elasticsearch import helpers, TransportError
+
+from util import util
+
+
+logger = util.get_logger(__name__)
+
+
+class BulkWriter:
+    """
+    Elasticsearch bulk writer with throughput metrics and backpressure handling.
+
+    Actions are sent in chunks like with :func:`elasticsearch.helpers.bulk`, but items rejected by the
+    cluster (HTTP 429) are retried with exponential backoff and the chunk size is reduced whenever the
+    cluster pushes back. After successful chunks, the chunk size slowly grows back to its configured maximum.
+    The writer keeps track of sent documents and bytes, rejections and request latencies,
+    which are logged periodically and by :meth:`log_stats`.
+    """
+
+    def __init__(self, es, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, min_chunk_size=10, thread_count=1,
+                 max_retries=8, initial_backoff=2.0, max_backoff=300.0, report_interval=60.0, name=None):
+        """
+        :param es: Elasticsearch client
+        :param chunk_size: maximum (and initial) number of documents per bulk request
+        :param max_chunk_bytes: maximum size of a bulk request in bytes
+        :param min_chunk_size: lower bound for the adaptive chunk size
+        :param thread_count: number of parallel bulk request threads
+        :param max_retries: maximum number of retries for rejected items
+        :param initial_backoff: seconds to wait before the first retry
+        :param max_backoff: maximum number of seconds to wait between retries
+        :param report_interval: seconds between periodic stats log messages (0 disables periodic logging)
+        :param name: writer name used as log prefix (e.g., worker or slice ID)
+        """
+        self.es = es
+        self.max_chunk_size = chunk_size
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.min_chunk_size = min(min_chunk_size, chunk_size)
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.report_interval = report_interval
+        self.name = name
+
+        self.docs = 0
+        self.bytes = 0
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+        # Latencies of the most recent requests
+        self._latencies = deque(maxlen=10000)
+        self._start_time = monotonic()
+        self._last_report = self._start_time
+        self._lock = threading.Lock()
+
+    def write(self, actions, raise_on_error=True):
+        """
+        Send actions to Elasticsearch.
+
+        :param actions: iterable of bulk actions (same format as for :func:`elasticsearch.helpers.bulk`)
+        :param raise_on_error: raise :class:`elasticsearch.helpers.BulkIndexError` if any items failed
+        :return: tuple of number of successfully processed actions and list of errors
+        """
+        chunks = self._chunk_actions(actions)
+        if self.thread_count > 1:
+            # Submit chunks one by one and bound the number of pending requests, so that actions
+            # are only read and chunked (with the current chunk size) as requests complete
+            results = []
+            pending = deque()
+            with ThreadPool(self.thread_count) as pool:
+                for chunk in chunks:
+                    if len(pending) >= self.thread_count * 2:
+                        results.append(pending.popleft().get())
+                    pending.append(pool.apply_async(self._send_chunk, (chunk,)))
+                results.extend(p.get() for p in pending)
+        else:
+            results = [self._send_chunk(c) for c in chunks]
+
+        success = sum(r[0] for r in results)
+        errors = [e for r in results for e in r[1]]
+        if errors and raise_on_error:
+            raise helpers.BulkIndexError('{} document(s) failed to index.'.format(len(errors)), errors)
+        return success, errors
+
+    def _chunk_actions(self, actions):
+        """
+        Serialize actions and split them into chunks according to the current chunk size.
+
+        :param actions: iterable of bulk actions
+        :return: generator of lists of serialized (action, data) line tuples
+        """
+        serializer = self.es.transport.serializer
+        chunk = []
+        chunk_bytes = 0
+        for action in actions:
+            action, data = helpers.expand_action(action)
+            lines = (serializer.dumps(action),) if data is None else (serializer.dumps(action), serializer.dumps(data))
+            size = sum(len(l.encode('utf-8')) + 1 for l in lines)
+
+            if chunk and (len(chunk) >= self.chunk_size or chunk_bytes + size > self.max_chunk_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+
+            chunk.append(lines)
+            chunk_bytes += size
+
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk):
+        """
+        Send one chunk and retry rejected items with exponential backoff.
+
+        :param chunk: list of serialized (action, data) line tuples
+        :return: tuple of number of successful items and list of errors
+        """
+        success = 0
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            body = '\n'.join(l for lines in chunk for l in lines) + '\n'
+            body_bytes = len(body.encode('utf-8'))
+
+            start = monotonic()
+            try:
+                response = self.es.bulk(body=body)
+                rejected = []
+                for lines, item in zip(chunk, response['items']):
+                    op_type, result = next(iter(item.items()))
+                    status = result.get('status', 500)
+                    if status == 429:
+                        rejected.append(lines)
+                    elif 200 <= status < 300 or (op_type == 'delete' and status == 404):
+                        success += 1
+                    else:
+                        errors.append({op_type: result})
+            except TransportError as e:
+                if e.status_code != 429:
+                    raise
+                rejected = chunk
+            self._record_request(monotonic() - start, len(chunk) - len(rejected), body_bytes, len(rejected))
+
+            if not rejected:
+                self._grow_chunk_size()
+                break
+
+            chunk = rejected
+            if attempt == self.max_retries:
+                errors.extend({'rejected': lines[0]} for lines in rejected)
+                break
+
+            self._shrink_chunk_size()
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+            logger.warning('{}{} item(s) rejected, retrying in {:.1f}s with chunk size {}'.format(
+                self._log_prefix(), len(rejected), backoff, self.chunk_size))
+            sleep(backoff)
+
+        with self._lock:
+            self.failed += len(errors)
+        return success, errors
+
+    def _shrink_chunk_size(self):
+        with self._lock:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+
+    def _grow_chunk_size(self):
+        with self._lock:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + max(1, self.chunk_size // 10))
+
+    def _record_request(self, latency, docs, num_bytes, rejected):
+        with self._lock:
+            self.requests += 1
+            self.docs += docs
+            self.bytes += num_bytes
+            self.rejected += rejected
+            self._latencies.append(latency)
+
+            report = self.report_interval and monotonic() - self._last_report >= self.report_interval
+            if report:
+                self._last_report = monotonic()
+
+        if report:
+            self.log_stats()
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        :param percentiles: percentiles to compute
+        :return: dict of bulk request latency percentiles in seconds
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return {p: 0.0 for p in percentiles}
+        return {p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] for p in percentiles}
+
+    def stats(self):
+        """
+        :return: dict of throughput statistics
+        """
+        elapsed = max(monotonic() - self._start_time, 1e-9)
+        with self._lock:
+            stats = {
+                'docs': self.docs,
+                'bytes': self.bytes,
+                'requests': self.requests,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'docs_per_sec': self.docs / elapsed,
+                'bytes_per_sec': self.bytes / elapsed,
+                'chunk_size': self.chunk_size
+            }
+        stats['latency'] = self.latency_percentiles()
+        return stats
+
+    def log_stats(self):
+        """
+        Log throughput statistics.
+        """
+        s = self.stats()
+        logger.info(('{}{} docs in {} requests ({:.1f} docs/s, {:.1f} KiB/s), {} rejected (429), {} failed, '
+                     'latency p50/p90/p99: {:.2f}s/{:.2f}s/{:.2f}s, chunk size {}').format(
+            self._log_prefix(), s['docs'], s['requests'], s['docs_per_sec'], s['bytes_per_sec'] / 1024,
+            s['rejected'], s['failed'], s['latency'][50], s['latency'][90], s['latency'][99], s['chunk_size']))
+
+    def _log_prefix(self):
+        return '[{}] '.format(self.name) if self.name else ''
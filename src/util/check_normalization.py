@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+import random
+import re
+import sys
+import unicodedata
+
+import click
+from tqdm import tqdm
+
+import util
+
+
+def _reference_normalize(text):
+    """
+    Original (unoptimized) implementation of :func:`util.util.normalize_message_text`,
+    which :class:`util.util.MessageNormalizer` has to reproduce exactly.
+
+    :param text: email text
+    :return: normalized message
+    """
+    if type(text) is bytes:
+        text = text.decode('utf-8', 'ignore')
+
+    if not text.strip():
+        return text
+
+    # Normalize email addresses
+    text = re.sub(r'([a-zA-Z0-9_\-./+]+)@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
+                  r'(([a-zA-Z0-9\-]+\.)+))([a-zA-Z]{2,}|[0-9]{1,3})(\]?)', ' @EMAIL@ ', text)
+
+    # Normalize URLs
+    text = re.sub(r'[a-zA-Z]{3,5}://[\w.-]+(?:\.[\w.-]+)+[\w\-._~:/?#[\]@!$&\'()*+,;=]+', ' @URL@ ', text)
+
+    # Normalize numbers
+    text = re.sub(r'\d', '0', text)
+    text = re.sub(r'0{5,}', '00000', text)
+
+    # Normalize hash values
+    text = re.sub(r'[0a-fA-F]{32,}', '@HASH@', text)
+
+    # Preserve indents
+    text = re.sub(r'(^|\n)[ \t]{4,}', r'\1@INDENT@ ', text)
+
+    # Split off special characters
+    text = re.sub(r'(^|[^<>|:.,;+=~!#*(){}\[\]])([<>|:.,;+=~!#*(){}\[\]]+)', r'\1 \2 ', text)
+
+    # Truncate runs of special characters
+    text = re.sub(r'([<>|:.,;+_=~\-!#*(){}\[\]]{5})[<>|:.,;+_=~\-!#*(){}\[\]]+', r'\1', text)
+
+    # Normalize Unicode
+    return unicodedata.normalize('NFKC', text)
+
+
+def _random_lines(num_lines, seed=0):
+    """
+    Generate random lines from characters that trigger the individual normalization rules.
+
+    :param num_lines: number of lines
+    :param seed: random seed
+    :return: list of lines
+    """
+    rand = random.Random(seed)
+    tokens = ['a', 'Z', '0', '7', '@', '.', '-', '_', '/', '://', 'http', 'ex.org', '[', ']', '    ', '\t', ' ',
+              '>', '|', ':', '=', '~', '#', '*', '(', ')', '{', '}', '00000', 'ff' * 20, 'ﬁ', 'Ａ', '²', 'ä']
+    return [''.join(rand.choice(tokens) for _ in range(rand.randint(0, 30))) + rand.choice(['', '\n'])
+            for _ in range(num_lines)]
+
+
+@click.command()
+@click.argument('input_files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('-r', '--random-lines', help='Number of additional random lines to check', type=int, default=100000)
+def main(input_files, random_lines):
+    """
+    Check that the optimized message normalizer produces the same output as the original
+    implementation for every message text and every line of the given JSONL files, both when
+    normalizing lines one by one and when normalizing all lines of a message at once.
+
+    Arguments:
+        input_files: JSONL files with a "text" field (default: annotations/*.jsonl)
+    """
+    if not input_files:
+        input_files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', '..', 'annotations', '*.jsonl')))
+
+    messages = []
+    for f in input_files:
+        with open(f, 'r') as json_file:
+            messages.extend([l + '\n' for l in json.loads(j)['text'].split('\n')] for j in json_file)
+    messages.append(_random_lines(random_lines))
+
+    num_lines = 0
+    mismatches = 0
+    for lines in tqdm(messages, desc='Checking messages', unit=' messages'):
+        expected = [_reference_normalize(l) for l in lines]
+        mismatches += _reference_normalize(''.join(lines)) != util.normalize_message_text(''.join(lines))
+        mismatches += sum(e != util.normalize_message_text(l) for l, e in zip(lines, expected))
+        mismatches += sum(e != n for e, n in zip(expected, util.normalize_message_lines(lines)))
+        num_lines += len(lines)
+
+    click.echo('Checked {} messages with {} lines: {} mismatches.'.format(len(messages), num_lines, mismatches))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
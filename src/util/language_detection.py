@@ -0,0 +1,109 @@
+from langdetect import DetectorFactory, detect_langs
+from langdetect.lang_detect_exception import LangDetectException
+
+# Make langdetect results reproducible
+DetectorFactory.seed = 0
+
+
+LANGUAGE_DETECTOR_BACKENDS = ('langdetect', 'fasttext')
+
+_language_detectors = {}
+
+
+class LangdetectLanguageDetector:
+    """Language detector running only the langdetect n-gram model on a bounded text prefix."""
+
+    def __init__(self, max_chars=10000):
+        """
+        :param max_chars: maximum number of characters to consider from each text
+        """
+        self.max_chars = max_chars
+
+    def detect(self, text):
+        """
+        Detect language of a text.
+
+        :param text: input text
+        :return: language code or None if no language could be detected
+        """
+        try:
+            return str(detect_langs(text[:self.max_chars])[0].lang)
+        except LangDetectException:
+            return None
+
+    def detect_batch(self, texts):
+        """
+        Detect languages of multiple texts.
+
+        :param texts: list of input texts
+        :return: list of language codes (None where no language could be detected)
+        """
+        return [self.detect(t) for t in texts]
+
+
+class FastTextLanguageDetector:
+    """
+    Language detector using a fastText language identification model (e.g., ``lid.176.bin``),
+    which classifies whole batches of texts in a single call and is much faster than langdetect.
+    """
+
+    def __init__(self, model_path, max_chars=10000):
+        """
+        :param model_path: path to the fastText language identification model
+        :param max_chars: maximum number of characters to consider from each text
+        """
+        import fastText
+
+        self.max_chars = max_chars
+        self.model = fastText.load_model(model_path)
+
+    def detect(self, text):
+        """
+        Detect language of a text.
+
+        :param text: input text
+        :return: language code or None if no language could be detected
+        """
+        return self.detect_batch([text])[0]
+
+    def detect_batch(self, texts):
+        """
+        Detect languages of multiple texts.
+
+        :param texts: list of input texts
+        :return: list of language codes (None where no language could be detected)
+        """
+        # fastText predicts one line per text
+        texts = [' '.join(t[:self.max_chars].split()) for t in texts]
+        non_empty = [i for i, t in enumerate(texts) if t]
+
+        langs = [None] * len(texts)
+        if non_empty:
+            labels, _ = self.model.predict([texts[i] for i in non_empty], k=1)
+            for i, l in zip(non_empty, labels):
+                langs[i] = l[0][len('__label__'):] if l else None
+        return langs
+
+
+def get_language_detector(backend='langdetect', max_chars=10000, model_path=None):
+    """
+    Get language detector for the given backend.
+    Detectors are created only once per Python worker and then reused.
+
+    :param backend: detector backend (one of :data:`LANGUAGE_DETECTOR_BACKENDS`)
+    :param max_chars: maximum number of characters to consider from each text
+    :param model_path: path to the fastText language identification model (required for ``fasttext``)
+    :return: language detector
+    """
+    key = (backend, max_chars, model_path)
+    if key not in _language_detectors:
+        if backend == 'langdetect':
+            _language_detectors[key] = LangdetectLanguageDetector(max_chars)
+        elif backend == 'fasttext':
+            if not model_path:
+                raise ValueError('The fasttext language detector requires a model path.')
+            _language_detectors[key] = FastTextLanguageDetector(model_path, max_chars)
+        else:
+            raise ValueError('Unknown language detector backend: {}'.format(backend))
+
+    return _language_detectors[key]
@@ -1,6 +1,8 @@
-from collections import deque
+from functools import partial
+from hashlib import sha256
 import multiprocessing
 import json
+import os
 
 import fastText
 import numpy as np
@@ -42,14 +44,24 @@ class MailLinesSequence(Sequence):
     LABEL_MAP_ONEHOT = {label: onehot for label, onehot in zip(_SEGMENT_LABEL_MAP, np.eye(len(_SEGMENT_LABEL_MAP)))}
 
     def __init__(self, input_data, context_shape, labeled=True, batch_size=None,
-                 input_is_raw_text=False, max_lines=None):
+                 input_is_raw_text=False, input_is_embedding_store=False, max_lines=None, line_embeddings=None,
+                 separate_mail_context=False):
         """
-        :param input_data: input JSON file (file handle or path) with training data or raw email text
+        :param input_data: input JSON file (file handle or path) with training data, raw email text
+                           or list of raw email texts
         :param context_shape: shape of the context window (2*context+1, line_len, word_dim)
         :param labeled: whether input contains labels
         :param batch_size: mini-batch size
         :param input_is_raw_text: whether input is a file or a raw email string
+        :param input_is_embedding_store: whether input is a precomputed embedding store directory
+                                         (see :meth:`save_embeddings`)
         :param max_lines: maximum number of lines to load from the input source (rest is discarded)
+        :param line_embeddings: precomputed (num_lines, line_len, word_dim) embeddings of the input lines
+                                (e.g., from a :class:`LineEmbeddingPool`), which are used instead of
+                                embedding the lines again
+        :param separate_mail_context: end the following context of every line at the end of its own mail
+                                      (by default, it only stops at a mail end which falls exactly on one
+                                      of its positions, like with the published segmentation models)
         """
         self.labeled = labeled
         self.mail_lines = []
@@ -60,15 +72,23 @@ class MailLinesSequence(Sequence):
         self.batch_size = batch_size
         self.line_shape = context_shape[1:]
         self.context_size = context_shape[0] // 2
+        self.separate_mail_context = separate_mail_context
         self.output_dim = len(self.LABEL_MAP)
 
-        if not input_is_raw_text:
-            if type(input_data) is str:
-                self._load_jsonl(open(input_data, 'r'), max_lines)
-            else:
-                self._load_jsonl(input_data, max_lines)
+        if input_is_embedding_store:
+            self._load_embedding_store(input_data)
         else:
-            self._load_raw_text(input_data, max_lines)
+            if not input_is_raw_text:
+                if type(input_data) is str:
+                    self._load_jsonl(open(input_data, 'r'), max_lines)
+                else:
+                    self._load_jsonl(input_data, max_lines)
+            else:
+                self._load_raw_text(input_data, max_lines)
+
+            self._embed_lines(line_embeddings)
+
+        self._build_context_indices()
 
     def _load_jsonl(self, json_file, max_lines):
         """
@@ -87,8 +107,8 @@ class MailLinesSequence(Sequence):
             elif self.labeled and mail_json['labels']:
                 lines = [l for l in annotation_dict_to_lines(mail_json)]
 
-            # Skip overly long mails (probably just excessive log data)
-            if len(lines) > 5000:
+            # Skip overly long training mails (probably just excessive log data), but predict all unlabeled mails
+            if self.labeled and lines and len(lines) > 5000:
                 continue
 
             if lines:
@@ -107,76 +127,144 @@ class MailLinesSequence(Sequence):
         """
         Split raw text into lines
 
-        :param raw_text: input text
-        :param max_lines: maximum number of lines to load from the text (rest is discarded).
+        :param raw_text: input text or list of input texts (each of which is treated as a separate mail)
+        :param max_lines: maximum number of lines to load from each text (rest is discarded).
         """
-        if max_lines is not None:
-            lines = [l + '\n' for l in raw_text.split('\n')[:max_lines]]
-        else:
-            lines = [l + '\n' for l in raw_text.split('\n')]
+        for text in ([raw_text] if type(raw_text) is str else raw_text):
+            lines = [l + '\n' for l in text.split('\n')[:max_lines]]
 
-        if lines:
-            self.mail_start_indices.add(len(self.mail_lines))
-            self.mail_lines.extend(lines)
-            self.mail_end_indices.add(len(self.mail_lines))
+            if lines:
+                self.mail_start_indices.add(len(self.mail_lines))
+                self.mail_lines.extend(lines)
+                self.mail_end_indices.add(len(self.mail_lines))
 
         if self.batch_size is None:
             self.batch_size = len(self.mail_lines)
 
+    def _embed_lines(self, line_embeddings=None):
+        """
+        Embed and pad every loaded line exactly once.
+
+        The resulting float32 matrix has one additional row at the end, which holds the padding line
+        used for context positions outside of a mail.
+
+        :param line_embeddings: precomputed line embeddings (optional)
+        """
+        self._line_embeddings = np.empty((len(self.mail_lines) + 1,) + self.line_shape, dtype=np.float32)
+        if line_embeddings is None:
+            embed_lines([line if not self.labeled else line[0] for line in self.mail_lines], self.line_shape,
+                        out=self._line_embeddings[:-1])
+        elif len(line_embeddings) != len(self.mail_lines):
+            raise ValueError('Got {} line embeddings for {} lines.'.format(len(line_embeddings), len(self.mail_lines)))
+        else:
+            self._line_embeddings[:-1] = line_embeddings
+        self._line_embeddings[-1] = 1.0
+
+        if self.labeled:
+            self._line_labels = np.array([line[1] for line in self.mail_lines],
+                                         dtype=np.float32).reshape((-1, self.output_dim))
+
+    def _load_embedding_store(self, store_path):
+        """
+        Memory-map precomputed line embeddings from an embedding store directory.
+
+        :param store_path: embedding store directory
+        """
+        with open(os.path.join(store_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        if tuple(meta['line_shape']) != self.line_shape:
+            raise ValueError('Embedding store line shape {} does not match expected shape {}.'.format(
+                tuple(meta['line_shape']), self.line_shape))
+        if self.labeled and not meta['labeled']:
+            raise ValueError('Embedding store does not contain labels.')
+
+        self._line_embeddings = np.load(os.path.join(store_path, 'lines.npy'), mmap_mode='r')
+        if self.labeled:
+            self._line_labels = np.load(os.path.join(store_path, 'labels.npy'), mmap_mode='r')
+
+        mail_offsets = np.load(os.path.join(store_path, 'mail_offsets.npy')).tolist()
+        self.mail_start_indices = set(mail_offsets[:-1])
+        self.mail_end_indices = set(mail_offsets[1:])
+
+        if self.batch_size is None:
+            self.batch_size = self.num_lines
+
+    def save_embeddings(self, store_path):
+        """
+        Save line embeddings, labels and mail boundaries to an embedding store directory,
+        which can later be memory-mapped instead of embedding the input data again.
+
+        :param store_path: output embedding store directory (must not exist)
+        """
+        tmp_path = store_path + '.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+
+        np.save(os.path.join(tmp_path, 'lines.npy'), self._line_embeddings)
+        if self.labeled:
+            np.save(os.path.join(tmp_path, 'labels.npy'), self._line_labels)
+        np.save(os.path.join(tmp_path, 'mail_offsets.npy'),
+                np.array(sorted(self.mail_start_indices) + [self.num_lines], dtype=np.int64))
+
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'num_lines': self.num_lines, 'line_shape': self.line_shape, 'labeled': self.labeled}, f)
+
+        # Only make store visible once it is complete
+        os.rename(tmp_path, store_path)
+
+    @property
+    def num_lines(self):
+        """Number of lines in this sequence."""
+        return self._line_embeddings.shape[0] - 1
+
+    def _build_context_indices(self):
+        """
+        Precompute the line indices of the context window of every line.
+
+        Context positions outside of a line's mail point to the padding row of the line embedding matrix,
+        so that a batch of context windows can be assembled with a single fancy-index gather.
+        """
+        num_lines = self.num_lines
+        line_indices = np.arange(num_lines)[:, np.newaxis]
+
+        # Boundaries of the mail each line belongs to
+        mail_starts = np.array(sorted(self.mail_start_indices), dtype=np.int64)
+        mail_ends = np.array(sorted(self.mail_end_indices), dtype=np.int64)
+        line_mails = np.searchsorted(mail_starts, line_indices, side='right') - 1
+        line_mail_starts = mail_starts[line_mails]
+        line_mail_ends = mail_ends[line_mails]
+
+        prev_indices = line_indices - np.arange(1, self.context_size + 1)
+        prev_indices[prev_indices < line_mail_starts] = num_lines
+
+        # Following context starts one window half after the current line. The published segmentation
+        # models were trained with context windows which only stop at a mail end if it falls exactly on one
+        # of their positions, so the following context of lines near the end of a mail may reach into the
+        # next mail of a multi-mail sequence.
+        next_indices = line_indices + self.context_size + 1 + np.arange(self.context_size)
+        if self.separate_mail_context:
+            next_indices[next_indices >= line_mail_ends] = num_lines
+        else:
+            next_padding = np.logical_or.accumulate(
+                (next_indices >= num_lines) | np.isin(next_indices, mail_ends), axis=1)
+            next_indices[next_padding] = num_lines
+
+        self._context_indices = np.hstack((prev_indices[:, ::-1], line_indices, next_indices))
+
     def __len__(self):
-        return int(np.ceil(len(self.mail_lines) / self.batch_size))
+        return int(np.ceil(self.num_lines / self.batch_size))
 
     def __getitem__(self, index):
         index = index * self.batch_size
-        end_index = index + self.batch_size if self.batch_size is not None else len(self.mail_lines)
-        end_index = min(end_index, len(self.mail_lines))
-
-        padding_line = np.ones(self.line_shape)
-        batch = np.empty((self.batch_size,) + self.line_shape)
-        batch_prev = np.empty((self.batch_size,) + self.line_shape)
-        batch_context = np.empty((self.batch_size, self.context_size * 2 + 1) + self.line_shape)
-        batch_labels = np.empty((self.batch_size, self.output_dim))
-
-        mail_slice = self.mail_lines[index:end_index]
-
-        def _get_line(line):
-            # Strip labels from line
-            return line if not self.labeled else line[0]
-
-        for i, line in enumerate(mail_slice):
-            if self.labeled:
-                batch_labels[i] = line[1]
-
-            context_lines = deque()
-
-            # Assemble previous context with padding
-            while len(context_lines) < self.context_size:
-                ci = index + i - len(context_lines) - 1
-                if ci < 0 or ci + 1 in self.mail_start_indices:
-                    context_lines.extendleft([padding_line] * (self.context_size - len(context_lines)))
-                    break
-                word_vecs = get_word_vectors(_get_line(self.mail_lines[ci]))
-                context_lines.appendleft(self._pad_line_vectors(word_vecs, self.line_shape[0]))
-
-            # Add current line to context
-            word_vecs = get_word_vectors(_get_line(line))
-            context_lines.append(self._pad_line_vectors(word_vecs, self.line_shape[0]))
-
-            # Assemble following context with padding
-            while len(context_lines) < 2 * self.context_size + 1:
-                ci = index + i + len(context_lines)
-                if ci >= len(self.mail_lines) or ci in self.mail_end_indices:
-                    context_lines.extend([padding_line] * ((2 * self.context_size + 1) - len(context_lines)))
-                    break
-                word_vecs = get_word_vectors(_get_line(self.mail_lines[ci]))
-                context_lines.append(self._pad_line_vectors(word_vecs, self.line_shape[0]))
-
-            batch[i] = context_lines[self.context_size]
-            batch_prev[i] = context_lines[self.context_size - 1]
-            batch_context[i] = np.stack(context_lines)
+        end_index = index + self.batch_size if self.batch_size is not None else self.num_lines
+        end_index = min(end_index, self.num_lines)
+
+        batch_context = self._line_embeddings[self._context_indices[index:end_index]]
+        batch = batch_context[:, self.context_size]
+        batch_prev = batch_context[:, self.context_size - 1]
 
         if self.labeled:
-            return [batch, batch_prev, batch_context], batch_labels
+            return [batch, batch_prev, batch_context], self._line_labels[index:end_index]
 
         return [batch, batch_prev, batch_context]
 
@@ -208,6 +296,92 @@ class MailLinesSequence(Sequence):
         return 10 if has_gpu() else 200
 
 
+def embed_lines(lines, line_shape, out=None):
+    """
+    Embed and pad lines of text.
+    Requires a fastText model to be loaded (see :func:`load_fasttext_model`)
+
+    :param lines: list of line texts
+    :param line_shape: shape of a padded line matrix (line_len, word_dim)
+    :param out: optional output array of shape (len(lines), line_len, word_dim)
+    :return: float32 array of line embeddings
+    """
+    if out is None:
+        out = np.empty((len(lines),) + tuple(line_shape), dtype=np.float32)
+
+    matrices = [_word_vector_cache.get(l) for l in lines]
+
+    # Normalize all uncached lines at once
+    uncached = list(dict.fromkeys(l for l, m in zip(lines, matrices) if m is None))
+    try:
+        normalized = dict(zip(uncached, util.normalize_message_lines(uncached)))
+    except Exception as e:
+        logger.error('Failed to normalize lines: {}'.format(e))
+        normalized = {}
+
+    computed = {}
+    for i, (line, matrix) in enumerate(zip(lines, matrices)):
+        if matrix is None:
+            if line not in computed:
+                computed[line] = _compute_word_vectors(line, normalized.get(line))
+            matrix = computed[line]
+        out[i] = MailLinesSequence._pad_line_vectors(matrix, line_shape[0])
+    return out
+
+
+class LineEmbeddingPool:
+    """
+    Pool of forked worker processes for normalizing and embedding lines in parallel.
+
+    Workers are forked from the current process, so they share the already loaded fastText model
+    (copy-on-write) instead of loading it again. The pool should therefore be created after
+    :func:`load_fasttext_model`, but before any threads are started or a TensorFlow session is created
+    (see :func:`parsing.message_segmenter.init_tf_session`, which is not called at import time for this reason).
+    """
+
+    def __init__(self, processes, line_shape):
+        """
+        :param processes: number of worker processes
+        :param line_shape: shape of a padded line matrix (line_len, word_dim)
+        """
+        if _fasttext_model is None:
+            raise RuntimeError("FastText vectors not loaded. Call load_fasttext_model() first.")
+
+        self.processes = processes
+        self.line_shape = tuple(line_shape)
+        self._pool = multiprocessing.get_context('fork').Pool(processes)
+
+    def embed_lines_async(self, lines):
+        """
+        Start embedding lines in the background.
+
+        :param lines: list of line texts
+        :return: function returning the (num_lines, line_len, word_dim) embedding array once it is ready
+        """
+        if not lines:
+            return lambda: np.empty((0,) + self.line_shape, dtype=np.float32)
+
+        # Split work into several parts per process to balance uneven line lengths
+        part_size = int(np.ceil(len(lines) / (self.processes * 4)))
+        parts = [lines[i:i + part_size] for i in range(0, len(lines), part_size)]
+        result = self._pool.map_async(partial(embed_lines, line_shape=self.line_shape), parts)
+        return lambda: np.concatenate(result.get())
+
+    def embed_lines(self, lines):
+        """
+        :param lines: list of line texts
+        :return: (num_lines, line_len, word_dim) embedding array
+        """
+        return self.embed_lines_async(lines)()
+
+    def close(self):
+        """
+        Shut down worker processes.
+        """
+        self._pool.close()
+        self._pool.join()
+
+
 def has_gpu():
     """
     :return: whether a GPU device is available
@@ -274,6 +448,27 @@ def line_labels_to_char_pos(line_labels):
     return labels
 
 
+def get_embedding_store_path(store_dir, fasttext_model, input_file, line_shape):
+    """
+    Get path of the embedding store for a given combination of fastText model and input file.
+
+    The store key is a hash over path, size and modification time of both files, so that stores
+    are invalidated automatically when either of them changes.
+
+    :param store_dir: embedding store base directory
+    :param fasttext_model: path to fastText model
+    :param input_file: path to input JSONL file
+    :param line_shape: shape of a padded line (line_len, word_dim)
+    :return: embedding store path
+    """
+    key = sha256()
+    for f in (fasttext_model, input_file):
+        stat = os.stat(f)
+        key.update('{}:{}:{}\n'.format(os.path.realpath(f), stat.st_size, stat.st_mtime_ns).encode())
+    key.update(str(tuple(line_shape)).encode())
+    return os.path.join(store_dir, '{}-{}'.format(os.path.basename(input_file), key.hexdigest()[:16]))
+
+
 def get_annotations_from_dict(d):
     """
     Get annotations from Doccano either one of the two Doccano export formats.
@@ -300,16 +495,54 @@ def load_fasttext_model(model_path):
         _fasttext_model = fastText.load_model(model_path)
 
 
+_word_vector_cache = util.LRUCache(20000)
+
+
+def set_word_vector_cache_size(max_size):
+    """
+    Set the maximum number of lines whose word vectors are cached by :func:`get_word_vectors`.
+    The cache is shared by all callers in the current process.
+
+    :param max_size: maximum number of cached lines (0 disables caching)
+    """
+    _word_vector_cache.resize(max_size)
+
+
+def get_word_vector_cache():
+    """
+    :return: the process-wide :class:`util.util.LRUCache` used by :func:`get_word_vectors`
+    """
+    return _word_vector_cache
+
+
 def get_word_vectors(text):
     """
     Tokenize text and return fastText word vectors.
     Requires a fastText model to be loaded (see :func:`load_fasttext_model`)
 
+    Results are cached by raw input text. The returned matrix is read-only.
+
+    :param text: input text
+    :return: word vector matrix
+    """
+    matrix = _word_vector_cache.get(text)
+    if matrix is not None:
+        return matrix
+    return _compute_word_vectors(text)
+
+
+def _compute_word_vectors(text, normalized_text=None):
+    """
+    Tokenize text, compute fastText word vectors and add them to the cache.
+
     :param text: input text
+    :param normalized_text: already normalized input text (optional)
     :return: word vector matrix
     """
     try:
-        matrix = [_fasttext_model.get_word_vector(w) for w in fastText.tokenize(util.normalize_message_text(text))]
+        if normalized_text is None:
+            normalized_text = util.normalize_message_text(text)
+        matrix = [_fasttext_model.get_word_vector(w) for w in fastText.tokenize(normalized_text)]
     except Exception as e:
         logger.error('Failed to tokenize line: {}'.format(e))
         matrix = [get_word_vector('')]
@@ -317,7 +550,10 @@ def get_word_vectors(text):
     if len(matrix) == 0:
         matrix = [get_word_vector('')]
 
-    return np.array(matrix)
+    matrix = np.array(matrix)
+    matrix.flags.writeable = False
+    _word_vector_cache.put(text, matrix)
+    return matrix
 
 
 def get_word_vector(word):
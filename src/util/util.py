@@ -1,10 +1,16 @@
+from collections import OrderedDict
 from glob import glob
+from hashlib import blake2b
 import logging
 import os
+import queue
+import random
 import re
+import threading
+import time
 import unicodedata
 
-from elasticsearch import Elasticsearch, ConnectionError as ESConnectionError
+from elasticsearch import Elasticsearch, ConnectionError as ESConnectionError, ConnectionTimeout, TransportError
 import pyspark
 
 from conf.settings import *
@@ -51,6 +57,107 @@ def get_es_client():
     return Elasticsearch(ES_SEED_HOSTS, **ES_CONNECTION_PROPERTIES, timeout=360)
 
 
+def stable_hash(value):
+    """
+    Deterministic signed 64-bit hash of a string.
+    Unlike Python's built-in :func:`hash`, the result does not depend on the process or its hash seed,
+    so it can be used as a document field (e.g., for distributing documents across scroll slices).
+
+    :param value: input string
+    :return: signed 64-bit integer (fits into an Elasticsearch `long` field)
+    """
+    return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def get_id_hash_range(slice_id, max_slices):
+    """
+    Split the signed 64-bit id_hash space (see :func:`stable_hash`) into equally sized ranges.
+
+    :param slice_id: slice ID
+    :param max_slices: total number of slices
+    :return: Elasticsearch range query parameters for the given slice
+    """
+    id_range = {}
+    if slice_id > 0:
+        id_range['gte'] = -2 ** 63 + slice_id * 2 ** 64 // max_slices
+    if slice_id < max_slices - 1:
+        id_range['lt'] = -2 ** 63 + (slice_id + 1) * 2 ** 64 // max_slices
+    return id_range
+
+
+class LRUCache:
+    """
+    Thread-safe bounded least-recently-used cache with hit and miss counters.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: maximum number of cached items (0 disables caching)
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get cached item and mark it as recently used.
+
+        :param key: item key
+        :param default: value to return if key is not cached
+        :return: cached value or `default`
+        """
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        """
+        Add item to cache, evicting the least recently used items if the cache is full.
+
+        :param key: item key
+        :param value: item value
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def resize(self, max_size):
+        """
+        Change maximum cache size, evicting items if necessary.
+
+        :param max_size: new maximum number of cached items
+        """
+        with self._lock:
+            self.max_size = max_size
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all items and reset counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """Ratio of cache hits to total lookups."""
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+
 def load_arglex(arglex_dir):
     """
     Load and parse Arguing Lexicon directory from
@@ -86,44 +193,150 @@ def load_arglex(arglex_dir):
     return rules_expanded
 
 
-def normalize_message_text(text):
+class MessageNormalizer:
     """
-    Preprocess email plaintext for segmentation.
+    Email plaintext normalizer for segmentation.
 
-    :param text: email text
-    :return: normalized message
+    All patterns are compiled once and rules which cannot possibly match a text are skipped.
     """
-    if type(text) is bytes:
-        text = text.decode('utf-8', 'ignore')
 
-    if not text.strip():
-        return text
+    _EMAIL_REGEX = re.compile(r'([a-zA-Z0-9_\-./+]+)@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
+                              r'(([a-zA-Z0-9\-]+\.)+))([a-zA-Z]{2,}|[0-9]{1,3})(\]?)')
+    _URL_REGEX = re.compile(r'[a-zA-Z]{3,5}://[\w.-]+(?:\.[\w.-]+)+[\w\-._~:/?#[\]@!$&\'()*+,;=]+')
+    _DIGIT_REGEX = re.compile(r'\d')
+    _ZERO_RUN_REGEX = re.compile(r'0{5,}')
+    _HASH_REGEX = re.compile(r'[0a-fA-F]{32,}')
+    _INDENT_REGEX = re.compile(r'(^|\n)[ \t]{4,}')
+    _SPECIAL_CHARS_REGEX = re.compile(r'(^|[^<>|:.,;+=~!#*(){}\[\]])([<>|:.,;+=~!#*(){}\[\]]+)')
+    _SPECIAL_CHARS_RUN_REGEX = re.compile(r'([<>|:.,;+_=~\-!#*(){}\[\]]{5})[<>|:.,;+_=~\-!#*(){}\[\]]+')
+
+    def normalize(self, text):
+        """
+        Preprocess email plaintext for segmentation.
+
+        :param text: email text
+        :return: normalized message
+        """
+        if type(text) is bytes:
+            text = text.decode('utf-8', 'ignore')
+
+        if not text.strip():
+            return text
+
+        return self._normalize(text)
+
+    def normalize_lines(self, lines):
+        """
+        Normalize a list of lines (e.g., all lines of a message) at once.
+        The output is the same as if each line were normalized individually with :meth:`normalize`.
+
+        :param lines: list of lines (with or without trailing newline)
+        :return: list of normalized lines
+        """
+        lines = [l.decode('utf-8', 'ignore') if type(l) is bytes else l for l in lines]
+        normalized = list(lines)
+
+        bulk_indices = []
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+
+            # Lines with inner line breaks cannot be split apart again after bulk normalization
+            if '\n' in line[:-1]:
+                normalized[i] = self._normalize(line)
+                continue
+
+            bulk_indices.append(i)
+
+        if not bulk_indices:
+            return normalized
+
+        # No rule matches across line breaks, so each rule can be applied to all lines it is applicable to at once
+        parts = [lines[i][:-1] if lines[i].endswith('\n') else lines[i] for i in bulk_indices]
+        all_parts = range(len(parts))
+
+        self._sub_parts(parts, [i for i in all_parts if '@' in parts[i]], self._EMAIL_REGEX, ' @EMAIL@ ')
+        self._sub_parts(parts, [i for i in all_parts if '://' in parts[i]], self._URL_REGEX, ' @URL@ ')
+        self._sub_parts(parts, all_parts, self._DIGIT_REGEX, '0')
+        self._sub_parts(parts, [i for i in all_parts if '00000' in parts[i]], self._ZERO_RUN_REGEX, '00000')
+        self._sub_parts(parts, [i for i in all_parts if len(parts[i]) >= 32], self._HASH_REGEX, '@HASH@')
+        self._sub_parts(parts, [i for i in all_parts if parts[i][:4] and not parts[i][:4].strip(' \t')],
+                        self._INDENT_REGEX, r'\1@INDENT@ ')
+        self._sub_parts(parts, all_parts, self._SPECIAL_CHARS_REGEX, r'\1 \2 ')
+        self._sub_parts(parts, [i for i in all_parts if len(parts[i]) >= 6], self._SPECIAL_CHARS_RUN_REGEX, r'\1')
+
+        for i, part in zip(bulk_indices, parts):
+            if not part.isascii():
+                part = unicodedata.normalize('NFKC', part)
+            normalized[i] = part + '\n' if lines[i].endswith('\n') else part
+
+        return normalized
 
-    # Normalize email addresses
-    text = re.sub(r'([a-zA-Z0-9_\-./+]+)@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|' +
-                  r'(([a-zA-Z0-9\-]+\.)+))([a-zA-Z]{2,}|[0-9]{1,3})(\]?)', ' @EMAIL@ ', text)
+    @staticmethod
+    def _sub_parts(parts, indices, regex, repl):
+        """Apply regex substitution to the given line parts in a single pass."""
+        if not indices:
+            return
 
-    # Normalize URLs
-    text = re.sub(r'[a-zA-Z]{3,5}://[\w.-]+(?:\.[\w.-]+)+[\w\-._~:/?#[\]@!$&\'()*+,;=]+', ' @URL@ ', text)
+        for i, part in zip(indices, regex.sub(repl, '\n'.join(parts[i] for i in indices)).split('\n')):
+            parts[i] = part
 
-    # Normalize numbers
-    text = re.sub(r'\d', '0', text)
-    text = re.sub(r'0{5,}', '00000', text)
+    def _normalize(self, text):
+        # Normalize email addresses
+        if '@' in text:
+            text = self._EMAIL_REGEX.sub(' @EMAIL@ ', text)
 
-    # Normalize hash values
-    text = re.sub(r'[0a-fA-F]{32,}', '@HASH@', text)
+        # Normalize URLs
+        if '://' in text:
+            text = self._URL_REGEX.sub(' @URL@ ', text)
 
-    # Preserve indents
-    text = re.sub(r'(^|\n)[ \t]{4,}', r'\1@INDENT@ ', text)
+        # Normalize numbers
+        text, num_digits = self._DIGIT_REGEX.subn('0', text)
+        if num_digits >= 5:
+            text = self._ZERO_RUN_REGEX.sub('00000', text)
 
-    # Split off special characters
-    text = re.sub(r'(^|[^<>|:.,;+=~!#*(){}\[\]])([<>|:.,;+=~!#*(){}\[\]]+)', r'\1 \2 ', text)
+        # Normalize hash values
+        if len(text) >= 32:
+            text = self._HASH_REGEX.sub('@HASH@', text)
 
-    # Truncate runs of special characters
-    text = re.sub(r'([<>|:.,;+_=~\-!#*(){}\[\]]{5})[<>|:.,;+_=~\-!#*(){}\[\]]+', r'\1', text)
+        # Preserve indents
+        if '    ' in text or '\t' in text:
+            text = self._INDENT_REGEX.sub(r'\1@INDENT@ ', text)
 
-    # Normalize Unicode
-    return unicodedata.normalize('NFKC', text)
+        # Split off special characters
+        text = self._SPECIAL_CHARS_REGEX.sub(r'\1 \2 ', text)
+
+        # Truncate runs of special characters
+        if len(text) >= 6:
+            text = self._SPECIAL_CHARS_RUN_REGEX.sub(r'\1', text)
+
+        # Normalize Unicode
+        if text.isascii():
+            return text
+        return unicodedata.normalize('NFKC', text)
+
+
+_message_normalizer = MessageNormalizer()
+
+
+def normalize_message_text(text):
+    """
+    Preprocess email plaintext for segmentation.
+
+    :param text: email text
+    :return: normalized message
+    """
+    return _message_normalizer.normalize(text)
+
+
+def normalize_message_lines(lines):
+    """
+    Preprocess all lines of an email plaintext for segmentation at once.
+
+    :param lines: list of lines
+    :return: list of normalized lines
+    """
+    return _message_normalizer.normalize_lines(lines)
 
 
 def decode_message_part(message_part):
@@ -244,22 +457,216 @@ def retrieve_email_thread(es, index, message_id, restrict_to_same_group=True):
     return sorted(docs, key=lambda d: d['sort'])
 
 
-def es_retry(func, *args, retries=3, **kwargs):
+class RetryPolicy:
+    """
+    Retry policy for Elasticsearch calls with jittered exponential backoff.
+
+    Calls are retried on connection errors and timeouts as well as on transport errors with
+    retryable HTTP status codes (429 Too Many Requests and 503 Service Unavailable by default).
+    """
+
+    def __init__(self, max_retries=10, initial_backoff=1.0, max_backoff=120.0, max_elapsed=1800.0,
+                 retry_on=(ESConnectionError, ConnectionTimeout), retry_on_status=(429, 503), never_retry_on=()):
+        """
+        :param max_retries: maximum number of retries
+        :param initial_backoff: maximum number of seconds to wait before the first retry
+        :param max_backoff: maximum number of seconds to wait between two retries
+        :param max_elapsed: do not retry anymore after this many seconds since the first attempt
+        :param retry_on: exception types to retry on
+        :param retry_on_status: HTTP status codes of :class:`elasticsearch.TransportError` to retry on
+        :param never_retry_on: exception types not to retry on, even if they are subclasses of `retry_on`
+        """
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_elapsed = max_elapsed
+        self.retry_on = tuple(retry_on)
+        self.retry_on_status = set(retry_on_status)
+        self.never_retry_on = tuple(never_retry_on)
+
+    def is_retryable(self, exception):
+        """
+        :param exception: raised exception
+        :return: whether the failed call should be retried
+        """
+        if isinstance(exception, self.never_retry_on):
+            return False
+        if isinstance(exception, self.retry_on):
+            return True
+        return isinstance(exception, TransportError) and exception.status_code in self.retry_on_status
+
+    def get_backoff(self, attempt):
+        """
+        :param attempt: number of the failed attempt (starting at 0)
+        :return: randomized number of seconds to wait before the next attempt ("full jitter")
+        """
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call function with parameters and retry according to this policy.
+
+        :param func: function to call
+        :return: function result
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+                backoff = self.get_backoff(attempt)
+                if time.monotonic() - start + backoff > self.max_elapsed:
+                    raise
+
+                get_logger(__name__).warning('{} (retrying in {:.1f}s, attempt {}/{})'.format(
+                    e, backoff, attempt + 1, self.max_retries))
+                time.sleep(backoff)
+                attempt += 1
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# Scroll requests are not idempotent: if a timed-out request was processed by the server anyway,
+# retrying it with the same scroll ID would silently skip a page, so timeouts are not retried
+SCROLL_RETRY_POLICY = RetryPolicy(never_retry_on=(ConnectionTimeout,))
+
+
+def es_retry(func, *args, policy=None, **kwargs):
     """
     Call Elasticsearch function with parameters and return result.
-    Logs connection errors and retries up to `retries` times in case of failure.
+    Logs transient errors (connection errors, timeouts, rejections) and retries according to the given
+    retry policy in case of failure.
 
     :param func: Elasticsearch call
-    :param retries: number of retries
+    :param policy: :class:`RetryPolicy` to use (default: :data:`DEFAULT_RETRY_POLICY`)
+    """
+    return (policy or DEFAULT_RETRY_POLICY).call(func, *args, **kwargs)
+
+
+def es_scan(es, index, body=None, scroll='10m', size=1000, policy=None, scroll_policy=None, **kwargs):
+    """
+    Scroll over all documents matching a query and retry every search and scroll request
+    according to the given retry policies.
+
+    :param es: Elasticsearch client
+    :param index: Elasticsearch index
+    :param body: search request body
+    :param scroll: scroll context timeout
+    :param size: scroll batch size
+    :param policy: :class:`RetryPolicy` for the initial search (default: :data:`DEFAULT_RETRY_POLICY`)
+    :param scroll_policy: :class:`RetryPolicy` for scroll requests (default: :data:`SCROLL_RETRY_POLICY`)
+    :return: generator of hits
+    """
+    results = es_retry(es.search, index=index, body=body, scroll=scroll, size=size, policy=policy, **kwargs)
+    try:
+        while results['hits']['hits']:
+            yield from results['hits']['hits']
+            results = es_retry(es.scroll, scroll_id=results['_scroll_id'], scroll=scroll,
+                               policy=scroll_policy or SCROLL_RETRY_POLICY)
+    finally:
+        es.clear_scroll(scroll_id=results['_scroll_id'])
+
+
+def es_search_after(es, index, body, size=1000, search_after=None, policy=None, **kwargs):
+    """
+    Page through all documents matching a sorted query with ``search_after``.
+
+    Unlike scroll requests, page requests are stateless, so every request (including timed-out ones)
+    is retried according to the given retry policy. The sort order of the query must be total
+    (i.e., end with a unique tiebreaker field), otherwise documents may be skipped or repeated.
+
+    :param es: Elasticsearch client
+    :param index: Elasticsearch index
+    :param body: search request body with a "sort" clause
+    :param size: page size
+    :param search_after: sort values of the document to resume after (optional)
+    :param policy: :class:`RetryPolicy` to use (default: :data:`DEFAULT_RETRY_POLICY`)
+    :return: generator of pages (lists of hits)
     """
-    ex = None
-    for _ in range(retries):
+    body = dict(body)
+    while True:
+        if search_after is not None:
+            body['search_after'] = search_after
+        hits = es_retry(es.search, index=index, body=body, size=size, policy=policy, **kwargs)['hits']['hits']
+        if not hits:
+            return
+        search_after = hits[-1]['sort']
+        yield hits
+
+
+def run_pipeline(source, *stages, queue_size=2):
+    """
+    Run an input iterable and a sequence of processing functions as a pipeline of threads connected
+    by bounded queues, so that each stage can work on the next item while the following stage
+    is still busy with the previous one. Items are processed in order by every stage.
+    If any stage fails, the whole pipeline is stopped and the exception is re-raised.
+
+    :param source: iterable of input items (consumed in its own thread)
+    :param stages: functions applied to each item one after another, each in its own thread
+                   (results of the last stage are discarded)
+    :param queue_size: maximum number of items waiting between two stages
+    """
+    end = object()
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return end
+
+    def run_source():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+            put(queues[0], end)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def run_stage(func, in_queue, out_queue):
         try:
-            return func(*args, **kwargs)
-        except ESConnectionError as e:
-            get_logger(__name__).error(e)
-            ex = e
-            pass
-
-    # Too many retries, bail out
-    raise ex
+            while True:
+                item = get(in_queue)
+                if item is end:
+                    if out_queue is not None:
+                        put(out_queue, end)
+                    return
+
+                result = func(item)
+                if out_queue is not None and not put(out_queue, result):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=run_source, daemon=True)]
+    for i, func in enumerate(stages):
+        out_queue = queues[i + 1] if i + 1 < len(stages) else None
+        threads.append(threading.Thread(target=run_stage, args=(func, queues[i], out_queue), daemon=True))
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
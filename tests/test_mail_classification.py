@@ -0,0 +1,91 @@
+import numpy as np
+
+from util.mail_classification import MailLinesSequence
+
+
+def _make_sequence(mails, context_shape=(5, 2, 3), **kwargs):
+    num_lines = sum(len(m.split('\n')) for m in mails)
+    return MailLinesSequence(mails, context_shape, labeled=False, input_is_raw_text=True,
+                             line_embeddings=np.zeros((num_lines,) + context_shape[1:]), **kwargs)
+
+
+def test_context_indices_multi_mail_default_layout():
+    # Two mails with lines 0-2 and 3-6, padding row is 7
+    seq = _make_sequence(['a\nb\nc', 'd\ne\nf\ng'])
+    np.testing.assert_array_equal(seq._context_indices, [
+        [7, 7, 0, 7, 7],
+        [7, 0, 1, 4, 5],
+        [0, 1, 2, 5, 6],
+        [7, 7, 3, 6, 7],
+        [7, 3, 4, 7, 7],
+        [3, 4, 5, 7, 7],
+        [4, 5, 6, 7, 7]
+    ])
+
+
+def test_context_indices_multi_mail_separate_mail_context():
+    seq = _make_sequence(['a\nb\nc', 'd\ne\nf\ng'], separate_mail_context=True)
+    np.testing.assert_array_equal(seq._context_indices, [
+        [7, 7, 0, 7, 7],
+        [7, 0, 1, 7, 7],
+        [0, 1, 2, 7, 7],
+        [7, 7, 3, 6, 7],
+        [7, 3, 4, 7, 7],
+        [3, 4, 5, 7, 7],
+        [4, 5, 6, 7, 7]
+    ])
+
+
+def test_context_indices_single_mail_layouts_equal():
+    mail = '\n'.join('line {}'.format(i) for i in range(30))
+    np.testing.assert_array_equal(_make_sequence([mail], (9, 2, 3))._context_indices,
+                                  _make_sequence([mail], (9, 2, 3), separate_mail_context=True)._context_indices)
+
+
+def _reference_context_windows(seq, line_embeddings):
+    """
+    Context windows as assembled by the original per-line loop of :meth:`MailLinesSequence.__getitem__`.
+    """
+    padding_line = np.ones(seq.line_shape)
+    num_lines = len(seq.mail_lines)
+    windows = []
+    for i in range(num_lines):
+        context_lines = []
+        while len(context_lines) < seq.context_size:
+            ci = i - len(context_lines) - 1
+            if ci < 0 or ci + 1 in seq.mail_start_indices:
+                context_lines = [padding_line] * (seq.context_size - len(context_lines)) + context_lines
+                break
+            context_lines.insert(0, line_embeddings[ci])
+
+        context_lines.append(line_embeddings[i])
+
+        while len(context_lines) < 2 * seq.context_size + 1:
+            ci = i + len(context_lines)
+            if ci >= num_lines or ci in seq.mail_end_indices:
+                context_lines.extend([padding_line] * ((2 * seq.context_size + 1) - len(context_lines)))
+                break
+            context_lines.append(line_embeddings[ci])
+
+        windows.append(np.stack(context_lines))
+    return np.stack(windows)
+
+
+def test_context_windows_match_per_line_loop():
+    rand = np.random.RandomState(0)
+    context_shape = (9, 2, 3)
+    mail_lengths = [1, 2, 3, 4, 5, 8, 9, 10, 17, 40] + list(rand.randint(1, 30, size=20))
+    rand.shuffle(mail_lengths)
+    mails = ['\n'.join(['line'] * n) for n in mail_lengths]
+    line_embeddings = rand.rand(sum(mail_lengths), *context_shape[1:]).astype(np.float32)
+
+    seq = MailLinesSequence(mails, context_shape, labeled=False, batch_size=16, input_is_raw_text=True,
+                            line_embeddings=line_embeddings)
+    expected = _reference_context_windows(seq, line_embeddings)
+
+    for b in range(len(seq)):
+        batch, batch_prev, batch_context = seq[b]
+        expected_batch = expected[b * seq.batch_size:(b + 1) * seq.batch_size]
+        np.testing.assert_array_equal(batch_context, expected_batch)
+        np.testing.assert_array_equal(batch, expected_batch[:, seq.context_size])
+        np.testing.assert_array_equal(batch_prev, expected_batch[:, seq.context_size - 1])
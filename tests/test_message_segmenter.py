@@ -0,0 +1,78 @@
+import io
+import json
+import random
+
+import fastText
+import numpy as np
+import pytest
+
+from parsing.message_segmenter import CONTEXT_SHAPE, _iter_prediction_sequences, _pack_message_chunks, _WindowedMail
+from util.mail_classification import load_fasttext_model, MailLinesSequence
+
+
+def test_pack_message_chunks_max_lines():
+    rand = random.Random(0)
+    messages = ['\n'.join(['line'] * rand.randint(1, 400)) for _ in range(200)]
+    max_lines = 300
+
+    groups = list(_pack_message_chunks(messages, 100, max_lines))
+    for chunks in groups:
+        num_lines = sum(chunk.count('\n') + 1 for _, chunk, _, _ in chunks)
+        assert num_lines <= max_lines or len(chunks) == 1
+
+    # Groups are only closed when the next chunk would not fit
+    for chunks, next_chunks in zip(groups[:-1], groups[1:]):
+        num_lines = sum(chunk.count('\n') + 1 for _, chunk, _, _ in chunks + next_chunks[:1])
+        assert num_lines > max_lines
+
+    # Chunks cover every line of every message exactly once and in order
+    covered = [0] * len(messages)
+    for i, _, _, chunk_lines in (c for chunks in groups for c in chunks):
+        assert all(n == len(m.split('\n')) for n, m in zip(covered[:i], messages))
+        covered[i] += chunk_lines
+    assert covered == [len(m.split('\n')) for m in messages]
+
+
+@pytest.fixture(scope='module')
+def fasttext_model(tmp_path_factory):
+    tmp_dir = tmp_path_factory.mktemp('fasttext')
+    corpus = tmp_dir / 'corpus.txt'
+    corpus.write_text('\n'.join('line {} of some mail text > quoted'.format(i) for i in range(200)))
+    model = fastText.train_unsupervised(str(corpus), dim=CONTEXT_SHAPE[2], minCount=1, epoch=1, thread=1)
+    model_path = str(tmp_dir / 'model.bin')
+    model.save_model(model_path)
+    load_fasttext_model(model_path)
+    return model_path
+
+
+class _RecordingModel:
+    """Context-dependent stand-in for a segmentation model which records the sizes of its input sequences."""
+
+    def __init__(self):
+        self.weights = np.random.RandomState(0).randn(np.prod(CONTEXT_SHAPE), len(MailLinesSequence.LABEL_MAP))
+        self.sequence_lines = []
+
+    def predict(self, pred_seq):
+        self.sequence_lines.append(pred_seq.num_lines)
+        logits = np.concatenate([pred_seq[i][2].reshape((-1, self.weights.shape[0])) @ self.weights
+                                 for i in range(len(pred_seq))])
+        return np.exp(logits - logits.max(axis=1, keepdims=True))
+
+
+def test_predict_long_unlabeled_mail_in_windows(fasttext_model):
+    chunk_size = 100
+    long_text = '\n'.join('line {}{}'.format(i, ' > quoted' * (i % 7 == 0)) for i in range(2000))
+    mails = [{'id': 0, 'text': 'line 1\nline 2'}, {'id': 1, 'text': long_text}, {'id': 2, 'text': 'line 3'}]
+
+    sequences = list(_iter_prediction_sequences(io.StringIO(''.join(json.dumps(m) + '\n' for m in mails)),
+                                                chunk_size))
+    assert [type(s) is _WindowedMail for s in sequences] == [False, True, False]
+    assert [m['id'] for s in sequences for m in s.mail_metadata_map.values()] == [0, 1, 2]
+
+    model = _RecordingModel()
+    predictions = sequences[1].predict(model)
+
+    # Only one window of lines is embedded at a time
+    assert max(model.sequence_lines) <= chunk_size + 3 * CONTEXT_SHAPE[0] * 2
+    expected = model.predict(MailLinesSequence(long_text, CONTEXT_SHAPE, labeled=False, input_is_raw_text=True))
+    np.testing.assert_allclose(predictions, expected, rtol=1e-5)